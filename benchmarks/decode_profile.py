@@ -0,0 +1,51 @@
+"""Measures decoding of large synthetic profiles, both uncached and through the profile cache.
+
+Usage: python benchmarks/decode_profile.py [entry count]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cbor2
+from homething import decode
+
+
+def synthetic_profile(count):
+    profile = [1]
+    while len(profile) - 1 < count:
+        i = len(profile) - 1
+        profile.extend([
+            # Switch controlling the relay that follows it, decoded inline.
+            [0, 4, 1],
+            [1, 5, 0, 1, i],
+            # DHT22 shared by two relays, decoded as an assignment.
+            [2, 12],
+            [1, 13, 1, 2, i + 2],
+            [1, 14, 1, 3, i + 2],
+            [5, 21, 22, 0x76],
+            [5, 21, 22, 0x77],
+            [8, 60],
+            [0, 15, 0],
+            [9, 16, "0101", "1010", i + 8],
+        ])
+    return profile
+
+
+def main(count):
+    profile = synthetic_profile(count)
+    data = cbor2.dumps(profile)
+    source = decode.decode(profile)
+    print(f"{len(profile) - 1} entries, {len(data)} bytes, {len(source)} characters")
+    benchmarks = [('decode', lambda: decode.decode(profile))]
+    if hasattr(decode, 'decode_cbor'):
+        assert decode.decode_cbor(data) == source
+        benchmarks.append(('decode_cbor (cached)', lambda: decode.decode_cbor(data)))
+    for name, func in benchmarks:
+        number, total = timeit.Timer(func).autorange()
+        print(f"{name}: {total / number * 1000:.3f} ms per decode")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,74 @@
+"""Measures the memory retained per Device for a fleet of devices running the same firmware.
+
+Usage: python benchmarks/device_memory.py [device count]
+"""
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# htm.db creates homething.db in the current directory
+os.chdir(tempfile.mkdtemp())
+
+import cbor2
+from htm.devices import Devices
+
+INFO = {"version": "1.2.3-45-gabcdef0", "description": "Kitchen light", "capabilities": "flash4MB,ota,dht22",
+        "ip": "192.168.1.10"}
+TOPICS = cbor2.dumps([{0: [{"": 0}, {"": 0}], 1: [{"temperature": 6, "humidity": 7}, {}]},
+                      {"light": 0, "fan": 0, "dht22": 1}])
+PROFILE = cbor2.dumps([1, [1, 5, 0, 0], [1, 4, 0, 0], [2, 12]])
+PROPERTIES = {('light',): b'on', ('fan',): b'off', ('dht22', 'temperature'): b'21.50', ('dht22', 'humidity'): b'45.00'}
+
+
+def diag(uptime):
+    return json.dumps({"uptime": uptime, "mem": {"free": 23456, "low": 12345},
+                       "tasks": [{"name": name, "stackMinLeft": 512} for name in ("main", "mqtt", "wifi", "led")]
+                       }).encode()
+
+
+def ignored(obj):
+    return isinstance(obj, (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                            types.MethodType))
+
+
+def retained_size(roots, stop):
+    """Total size of the objects reachable from roots, each object is only counted once."""
+    seen = {id(obj) for obj in stop}
+    total = 0
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or ignored(obj):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+
+async def main(count):
+    devices = Devices()
+    for i in range(count):
+        uuid = f"{i:08x}-0000-4000-8000-000000000000"
+        devices.update_device(uuid, ['device', 'info'], json.dumps(INFO).encode(), True)
+        devices.update_device(uuid, ['device', 'topics'], TOPICS, True)
+        devices.update_device(uuid, ['device', 'profile'], PROFILE, True)
+        devices.update_device(uuid, ['device', 'status'], b'ok', True)
+        for uptime in (30, 60):
+            devices.update_device(uuid, ['device', 'diag'], diag(uptime), False)
+        for path, value in PROPERTIES.items():
+            devices.update_device(uuid, list(path), value, True)
+
+    gc.collect()
+    roots = [devices.devices, getattr(devices, 'online_deadlines', []), getattr(devices, 'routes', {})]
+    total = retained_size(roots, [devices])
+    print(f"{count} devices: {total} bytes, {total / count:.0f} bytes per device")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
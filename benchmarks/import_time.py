@@ -0,0 +1,52 @@
+"""Measures the time to import the profile modules in a fresh interpreter.
+
+Usage: python benchmarks/import_time.py [--runs N] [--max-ms MS]
+
+Exits with status 1 if the median import time is over --max-ms, so it can guard against import time regressions.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+MODULES = "homething.decode, homething.parse"
+
+
+def import_time():
+    """Returns the import time in ms of MODULES and the slowest modules imported, as reported by -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {MODULES}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules.append((int(cumulative) / 1000, name[1:].rstrip()))
+    # Nested imports are indented, modules imported at interpreter startup are not counted
+    total = sum(time for time, name in modules if name.startswith("homething."))
+    return total, sorted(modules, reverse=True)[:10]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the profile modules.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    # The first run may build the registry snapshot
+    import_time()
+    runs = [import_time() for _ in range(args.runs)]
+    median = statistics.median(total for total, _ in runs)
+    print(f"import {MODULES}: {median:.1f} ms median of {args.runs} runs")
+    for time, name in runs[-1][1]:
+        print(f"  {time:8.1f} ms {name}")
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"Import time is over {args.max_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
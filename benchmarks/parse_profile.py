@@ -0,0 +1,144 @@
+"""Checks the recursive descent profile parser against the parsimonious grammar and times both.
+
+Random profiles, and mutations of them, are parsed with both parsers. The entries, the processed profile and any
+error location and message and any warnings must match exactly.
+
+Usage: python benchmarks/parse_profile.py [case count] [seed]
+"""
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from homething.parse import ProfileSource, ProfileEntryError, ID, components
+
+NAMES = sorted(components)
+UNKNOWN_NAMES = ['unknown', 'x1', 'D1']
+WS = ['', '', ' ', '  ', '\n', '\t', ' \n ']
+
+
+def ws(rng):
+    return rng.choice(WS)
+
+
+def arg(rng, depth):
+    kind = rng.randrange(7 if depth < 2 else 6)
+    if kind == 0:
+        return str(rng.randrange(-2, 40))
+    if kind == 1:
+        return hex(rng.randrange(0, 256))
+    if kind == 2:
+        return '"' + rng.choice(['0101', 'on', 'a b']) + '"'
+    if kind in (3, 4):
+        return rng.choice(['D1', 'D2', 'RX', 'id1', 'id2', 'missing'])
+    if kind == 5:
+        return str(rng.randrange(0, 2))
+    return definition(rng, depth + 1)
+
+
+def definition(rng, depth=0):
+    args = [ws(rng) + arg(rng, depth) + ws(rng) for _ in range(rng.randrange(5))]
+    name = rng.choice(UNKNOWN_NAMES if rng.random() < 0.02 else NAMES)
+    return name + '(' + ','.join(args) + ')'
+
+
+def line(rng):
+    kind = rng.randrange(6)
+    if kind == 0:
+        return '%board:' + ws(rng) + rng.choice(['nodemcu', 'unknown'])
+    if kind == 1:
+        return rng.choice(['id1', 'id2', 'x']) + ws(rng) + '=' + ws(rng) + definition(rng)
+    return definition(rng)
+
+
+def profile(rng, lines):
+    return ws(rng) + '\n'.join(line(rng) for _ in range(lines)) + ws(rng)
+
+
+def mutate(rng, text):
+    for _ in range(rng.randrange(1, 3)):
+        pos = rng.randrange(len(text) + 1)
+        action = rng.randrange(3)
+        if action == 0:
+            text = text[:pos] + text[pos + 1:]
+        elif action == 1:
+            text = text[:pos] + rng.choice('(),=" %x0\n') + text[pos:]
+        else:
+            text = text[:pos] + text[pos:pos + 4][::-1] + text[pos + 4:]
+    return text
+
+
+def describe(value):
+    if isinstance(value, list):
+        return [describe(item) for item in value]
+    if isinstance(value, ID):
+        return 'ID', value.name
+    if hasattr(value, '__dict__'):
+        return type(value).__name__, {key: describe(item) for key, item in vars(value).items()
+                                      if key not in ('source', 'id_table')}
+    return value
+
+
+def outcome(text, use_grammar):
+    """Parses and processes text, returning the entries, profile, error and warnings."""
+    source = ProfileSource(use_grammar=use_grammar)
+    source.text = text
+    return parse_and_process(source) + (source.diagnostics,)
+
+
+def parse_and_process(source):
+    try:
+        source.parse()
+    except ProfileEntryError as e:
+        return 'parse', e.location, e.message, source.message_for_location(e.location, 'error', e.message)
+    entries = describe(source.entries)
+    try:
+        return 'ok', entries, source.process()
+    except ProfileEntryError as e:
+        return 'process', entries, e.location, e.message
+    except AttributeError as e:
+        return 'process', entries, str(e)
+
+
+def check(count, seed):
+    rng = random.Random(seed)
+    results = {}
+    for i in range(count):
+        text = profile(rng, rng.randrange(1, 8))
+        if i % 2:
+            text = mutate(rng, text)
+        expected = outcome(text, True)
+        actual = outcome(text, False)
+        if expected != actual:
+            print(f"Mismatch for {text!r}:\n  grammar: {expected}\n  parser:  {actual}")
+            return False
+        results[expected[0]] = results.get(expected[0], 0) + 1
+    print(f"{count} profiles match: {results}")
+    return True
+
+
+def timed(text, use_grammar):
+    source = ProfileSource(use_grammar=use_grammar)
+    source.text = text
+    gc.collect()
+    start = time.perf_counter()
+    source.parse()
+    return time.perf_counter() - start
+
+
+def benchmark(lines):
+    text = '%board: nodemcu\n' + '\n'.join(
+        f'id{i} = dht22(D{i % 8})\ntemperatureControlledRelay(D{(i + 1) % 8}, 1, id{i})\n'
+        f'switchedRelay(5, 0, toggleSwitch(4))\nbme280(D1, D2, 0x77)' for i in range(lines // 4))
+    print(f"{text.count(chr(10)) + 1} lines, {len(text)} characters")
+    for name, use_grammar in (('grammar', True), ('parser', False)):
+        print(f"{name}: {timed(text, use_grammar) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    if not check(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 1):
+        sys.exit(1)
+    benchmark(4000)
@@ -0,0 +1,79 @@
+"""Measures serving a firmware image to many devices at once, with FirmwareHandler and with StaticFileHandler.
+
+Usage: python benchmarks/serve_firmware.py [device count] [image size in KB]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, StaticFileHandler
+from htm.updates import UpdateManager
+from htm.web import FirmwareHandler
+
+FILENAME = 'homething__1.0.ota'
+ROUNDS = 3
+
+
+def serve(handlers, sock, connection):
+    """Runs the server in its own process so its CPU time is measured without the client's."""
+    async def main():
+        # HTM runs with debug=True, which turns off StaticFileHandler's hash cache
+        server = HTTPServer(Application(handlers, static_hash_cache=False))
+        server.add_sockets([sock])
+        while True:
+            await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+            connection.send(time.process_time())
+
+    asyncio.run(main())
+
+
+async def download_all(port, count, data, connection):
+    client = AsyncHTTPClient(max_clients=count)
+    url = f'http://127.0.0.1:{port}/firmware/{FILENAME}'
+    connection.send(None)
+    server_start = connection.recv()
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.fetch(url) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    connection.send(None)
+    server_cpu = connection.recv() - server_start
+    assert all(response.body == data for response in responses)
+    # Resuming a download from half way
+    resumed = await client.fetch(url, headers={'Range': f'bytes={len(data) // 2}-'})
+    assert resumed.code == 206 and resumed.body == data[len(data) // 2:]
+    return elapsed, server_cpu
+
+
+def run(name, handlers, count, data):
+    sock, port = bind_unused_port()
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(handlers, sock, child_connection), daemon=True)
+    process.start()
+    # The first download reads the image
+    asyncio.run(download_all(port, 1, data, connection))
+    # Timings vary from run to run, the fastest of a few runs is reported
+    wall, cpu = min(asyncio.run(download_all(port, count, data, connection)) for _ in range(ROUNDS))
+    process.terminate()
+    print(f"{name}: {wall * 1000:.0f} ms, server {cpu * 1000:.0f} ms CPU for {count} downloads")
+
+
+def main(count, size):
+    data = os.urandom(size * 1024)
+    with tempfile.TemporaryDirectory() as updates_dir:
+        with open(os.path.join(updates_dir, FILENAME), 'wb') as f:
+            f.write(data)
+        run('StaticFileHandler', [(r'/firmware/(.*)', StaticFileHandler, dict(path=updates_dir))], count, data)
+        run('FirmwareHandler', [(r'/firmware/(.*)', FirmwareHandler, dict(updates=UpdateManager(updates_dir)))],
+            count, data)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 1024)
@@ -0,0 +1,92 @@
+"""Checks incremental profile validation against ProfileSource.compile() and times validating after an edit.
+
+Random profiles are edited a line at a time, after each edit the diagnostics from ProfileValidator must match those
+from compiling the whole text.
+
+Usage: python benchmarks/validate_profile.py [edit count] [seed]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from homething.parse import ProfileSource
+from homething.validate import ProfileValidator
+
+LINES = ['%board: nodemcu', 'id1 = dht22(D1)', 'id2 = dht22(D2)', 'id1 = dht22(3)', 'id3 = si7021(D1, D2)',
+         'temperatureControlledRelay(D5, 1, id1)', 'humidityControlledRelay(D6, 0, id2)',
+         'humidityControlledRelay(D6, 0, id3)', 'switchedRelay(5, 0, toggleSwitch(4))', 'relay(1)', 'relay(1, 2)',
+         'draytonscr(D7, "0101", "1010", id2)', 'unknown(1)', 'relay(', '', '  ', 'relay(1,\n0)', 'dht22(-1)',
+         'bme280(D1, D2, 0x77)', 'led_strip_spi(60)']
+
+
+def compiled(text):
+    source = ProfileSource()
+    source.text = text
+    source.compile()
+    return source.diagnostics
+
+
+def check(count, seed):
+    rng = random.Random(seed)
+    validator = ProfileValidator()
+    lines = [rng.choice(LINES) for _ in range(20)]
+    for _ in range(count):
+        index = rng.randrange(len(lines) + 1)
+        action = rng.randrange(3)
+        if action == 0 and lines:
+            del lines[min(index, len(lines) - 1)]
+        elif action == 1:
+            lines.insert(index, rng.choice(LINES))
+        elif lines:
+            lines[min(index, len(lines) - 1)] = rng.choice(LINES)
+        text = '\n'.join(lines)
+        _, diagnostics = validator.validate(text)
+        expected = compiled(text)
+        if diagnostics != expected:
+            print(f"Mismatch for {text!r}:\n  compile:  {expected}\n  validate: {diagnostics}")
+            return False
+    print(f"{count} edits match")
+    return True
+
+
+def benchmark(count):
+    lines = ['%board: nodemcu']
+    for i in range(count // 2):
+        lines += [f'id{i} = dht22(D{i % 8})', f'temperatureControlledRelay(D{(i + 1) % 8}, 1, id{i})']
+    validator = ProfileValidator()
+    text = '\n'.join(lines)
+    start = time.perf_counter()
+    validator.validate(text)
+    print(f"{len(lines)} lines, first validation: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    compiled(text)
+    print(f"compile: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # Typing a new line in the middle of the profile, one character at a time
+    middle = len(lines) // 2
+    typed = 'switchedRelay(D3, 0, toggleSwitch(D4))'
+    lines.insert(middle, '')
+    timings = []
+    for end in range(1, len(typed) + 1):
+        lines[middle] = typed[:end]
+        start = time.perf_counter()
+        validator.validate('\n'.join(lines))
+        timings.append(time.perf_counter() - start)
+    print(f"typing a line: {sum(timings) * 1000 / len(timings):.2f} ms per keystroke on average, "
+          f"{max(timings) * 1000:.2f} ms at most")
+
+    # Renaming an id used by the line after it
+    lines[1] = 'id_0 = dht22(D0)'
+    start = time.perf_counter()
+    validator.validate('\n'.join(lines))
+    print(f"renaming an id: {(time.perf_counter() - start) * 1000:.2f} ms, "
+          f"{validator.processed_lines} lines processed")
+
+if __name__ == '__main__':
+    if not check(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, int(sys.argv[2]) if len(sys.argv) > 2 else 1):
+        sys.exit(1)
+    benchmark(4000)
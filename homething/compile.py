@@ -0,0 +1,143 @@
+"""Compiles a directory tree of profile sources to CBOR profiles.
+
+Sources are compiled in parallel by a process pool. A source is skipped when its content, and the component and board
+definitions, are unchanged since it was last compiled. The outputs of sources that fail to compile, or no longer exist,
+are removed. One JSON object per source is written to stdout with the status and diagnostics of the source.
+
+Usage: python -m homething.compile [--jobs N] [--pattern *.profile] source_dir output_dir
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import os
+import os.path
+import sys
+
+import cbor2
+
+from .parse import ProfileSource
+from . import registry
+
+MANIFEST_NAME = ".profiles.json"
+
+
+def compile_source(filename, text):
+    """Returns the CBOR encoded profile, or None if it failed to compile, and the diagnostics for a source."""
+    source = ProfileSource()
+    source.filename = filename
+    source.text = text
+    try:
+        profile = source.compile()
+    except Exception as e:
+        return None, [dict(line=None, column=None, type='error', message=f'Internal error: {e!r}')]
+
+    diagnostics = []
+    for location, message_type, message in source.diagnostics:
+        line, column = source.line_and_column(location)
+        diagnostics.append(dict(line=line, column=column, type=message_type, message=message))
+    if profile is None:
+        return None, diagnostics
+    return cbor2.dumps(profile), diagnostics
+
+
+def find_sources(source_dir, pattern):
+    for dir_path, dir_names, filenames in os.walk(source_dir):
+        dir_names.sort()
+        for filename in sorted(fnmatch.filter(filenames, pattern)):
+            path = os.path.join(dir_path, filename)
+            yield os.path.relpath(path, source_dir)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_result(out, name, status, diagnostics):
+    out.write(json.dumps(dict(file=name, status=status, diagnostics=diagnostics)) + '\n')
+
+
+def output_path(output_dir, name):
+    return os.path.join(output_dir, os.path.splitext(name)[0] + '.cbor')
+
+
+def remove_output(output_dir, name):
+    try:
+        os.remove(output_path(output_dir, name))
+    except FileNotFoundError:
+        pass
+
+
+def compile_tree(source_dir, output_dir, pattern='*.profile', jobs=None, out=sys.stdout):
+    """Compiles the sources under source_dir matching pattern, returning the number that failed."""
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    pending = []
+    hashes = {}
+    sources = set()
+    for name in find_sources(source_dir, pattern):
+        sources.add(name)
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha256(registry.definitions_hash + data).hexdigest()
+        entry = manifest.get(name)
+        if entry is not None and entry['hash'] == content_hash and os.path.exists(output_path(output_dir, name)):
+            write_result(out, name, 'unchanged', entry['diagnostics'])
+            continue
+        hashes[name] = content_hash
+        pending.append((name, data.decode()))
+
+    # Sources that were deleted, or no longer match pattern, leave no output behind
+    for name in [name for name in manifest if name not in sources]:
+        del manifest[name]
+        remove_output(output_dir, name)
+
+    failed = 0
+
+    def store(name, profile, diagnostics):
+        nonlocal failed
+        if profile is None:
+            failed += 1
+            manifest.pop(name, None)
+            # A previous output would be mistaken for the compiled source
+            remove_output(output_dir, name)
+            write_result(out, name, 'failed', diagnostics)
+            return
+        path = output_path(output_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(profile)
+        manifest[name] = dict(hash=hashes[name], diagnostics=diagnostics)
+        write_result(out, name, 'compiled', diagnostics)
+
+    if jobs == 1 or len(pending) < 2:
+        for name, text in pending:
+            store(name, *compile_source(name, text))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            names = [name for name, _ in pending]
+            texts = [text for _, text in pending]
+            chunk_size = max(1, len(pending) // ((jobs or os.cpu_count() or 1) * 4))
+            for name, result in zip(names, executor.map(compile_source, names, texts, chunksize=chunk_size)):
+                store(name, *result)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a directory tree of HomeThing profiles to CBOR.")
+    parser.add_argument("source_dir", help="Directory to search for profile sources.")
+    parser.add_argument("output_dir", help="Directory to write compiled profiles to.")
+    parser.add_argument("--pattern", default="*.profile", help="Filename pattern of profile sources.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of worker processes, by default the number of CPUs.")
+    args = parser.parse_args()
+    sys.exit(1 if compile_tree(args.source_dir, args.output_dir, args.pattern, args.jobs) else 0)
@@ -1,9 +1,10 @@
 from collections import defaultdict
-import yaml
-import os.path
+from functools import lru_cache
+import cbor2
 
 from .constants import *
 from .errors import *
+from . import registry
 
 
 switch_types = {}
@@ -23,7 +24,7 @@ def decode_relay(entry):
     if relay_type == DeviceProfile_RelayController_None:
         return f'relay({pin}, {level})', None
     controller_id = entry[4]
-    return f'{relay_types[relay_type]}({pin}, {level}, id{controller_id})', controller_id
+    return (f'{relay_types[relay_type]}({pin}, {level}, ', ')'), controller_id
 
 
 def decode_led_strip_spi(entry):
@@ -36,7 +37,7 @@ def decode_draytonscr(entry):
     on_sequence = entry[2]
     off_sequence = entry[3]
     controller_id = entry[4]
-    return f'draytonscr({pin}, "{on_sequence}", "{off_sequence}", id{controller_id})', controller_id
+    return (f'draytonscr({pin}, "{on_sequence}", "{off_sequence}", ', ')'), controller_id
 
 
 class DecodeFactory:
@@ -70,27 +71,26 @@ decoders = {
     DeviceProfile_EntryType_DraytonSCR: decode_draytonscr
 }
 
-with open(os.path.join(os.path.dirname(__file__), "components.yaml")) as fp:
-    for name, details in yaml.safe_load(fp).items():
-        component_type = details['type']
+for name, details in registry.components.items():
+    component_type = details['type']
 
-        if component_type == 'gpio_pin':
-            decoders[details['id']] = GPIOPinComponentFactory(name, details)
+    if component_type == 'gpio_pin':
+        decoders[details['id']] = GPIOPinComponentFactory(name, details)
 
-        elif component_type == 'i2c':
-            decoders[details['id']] = I2CDeviceFactory(name, details)
+    elif component_type == 'i2c':
+        decoders[details['id']] = I2CDeviceFactory(name, details)
 
-        elif component_type == 'gpio_switch':
-            switch_types[details['switchType']] = name
+    elif component_type == 'gpio_switch':
+        switch_types[details['switchType']] = name
 
-        elif component_type == 'gpio_relay':
-            relay_types[details['relayType']] = name
+    elif component_type == 'gpio_relay':
+        relay_types[details['relayType']] = name
 
-        elif component_type in ('led_strip_spi', 'draytonscr'):
-            pass
+    elif component_type in ('led_strip_spi', 'draytonscr'):
+        pass
 
-        else:
-            raise RuntimeError(f"Unknown component type {component_type} for {name}")
+    else:
+        raise RuntimeError(f"Unknown component type {component_type} for {name}")
 
 
 def decode(profile):
@@ -98,21 +98,34 @@ def decode(profile):
     if version != 1:
         raise UnsupportedProfileVersionError()
     entries = []
+    references = []
     referenced_entries = defaultdict(list)
     for entry in profile[1:]:
         desc, used = decoders[entry[0]](entry)
         if used is not None:
             referenced_entries[used].append(len(entries))
+            references.append((len(entries), used))
         entries.append(desc)
-    source = ''
-    for i, entry in enumerate(entries):
-        if i in referenced_entries:
-            used_by = referenced_entries[i]
-            if len(used_by) == 1 and used_by[0] == i + 1:
-                entries[i + 1] = entries[i + 1].replace(f'id{i}', entry)
-            else:
-                source += f'id{i} = {entry}\n'
+
+    # Entries referencing another entry are decoded as the text either side of the reference, an entry only used by
+    # the entry following it is written inline, otherwise it is assigned an id.
+    for i, used in references:
+        prefix, suffix = entries[i]
+        if referenced_entries[used] == [used + 1]:
+            entries[i] = prefix + entries[used] + suffix
+            entries[used] = None
         else:
-            source += entry + '\n'
+            entries[i] = f'{prefix}id{used}{suffix}'
+    for i in referenced_entries:
+        if entries[i] is not None:
+            entries[i] = f'id{i} = {entries[i]}'
+
+    return ''.join([entry + '\n' for entry in entries if entry is not None])
+
+
+@lru_cache(maxsize=256)
+def decode_cbor(data):
+    """Decodes a CBOR encoded profile, results are cached by the encoded bytes as devices often share profiles.
 
-    return source
+    Profiles only contain arrays, integers and strings so their encoding is already canonical."""
+    return decode(cbor2.loads(data))
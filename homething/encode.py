@@ -1,8 +1,6 @@
-import yaml
-import os.path
-
 from .constants import *
 from .errors import *
+from . import registry
 
 
 class Component:
@@ -238,11 +236,10 @@ factories = {
 }
 
 components = {}
-with open(os.path.join(os.path.dirname(__file__), "components.yaml")) as fp:
-    for name, details in yaml.safe_load(fp).items():
-        component_type = details['type']
-        if component_type not in factories:
-            raise RuntimeError(f"Unknown componnet type {component_type} for {name}")
-        components[name] = factories[component_type](name, details)
+for name, details in registry.components.items():
+    component_type = details['type']
+    if component_type not in factories:
+        raise RuntimeError(f"Unknown componnet type {component_type} for {name}")
+    components[name] = factories[component_type](name, details)
 
 
@@ -7,6 +7,11 @@ class ProfileEntryError(Exception):
         self.message = message
 
 
+class ProfileParseError(ProfileEntryError):
+    def __init__(self, location):
+        super().__init__(location, "Failed to parse")
+
+
 class ProfileEntryWrongArgumentTypeError(ProfileEntryError):
     def __init__(self, arg, expected_types):
         type_name = type(arg.arg).__name__
@@ -0,0 +1,97 @@
+from parsimonious.grammar import Grammar
+from parsimonious.nodes import NodeVisitor
+from parsimonious.exceptions import ParseError, VisitationError
+
+from .parse import *
+
+grammar = Grammar(r"""
+start      = line* 
+line       = ws? (definition / assignment / board) ws?
+id         = ~"[a-z_][a-z0-9_]*"i
+number     = ~"-?[0-9]+"
+hex        = ~"0x[0-9a-f]+"i
+ws         = ~"\s*"
+lpar       = "("
+rpar       = ")"
+equal      =  ws? "=" ws?
+str        = ~'"[^\"]+"'
+arg        = ws? ( definition / id / str / hex/ number) ws?
+args       =  (arg "," args) / arg 
+definition = id "(" args? ")"
+board      = "%board:" ws? id
+assignment = id equal definition 
+""")
+
+
+class ProfileVisitor(NodeVisitor):
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        self.error = None
+
+    def raise_error(self, error):
+        self.error = error
+        raise error
+
+    def visit_start(self, node, visited_children):
+        return visited_children
+
+    def visit_str(self, node, visited_children):
+        return node.text[1:-1]
+
+    def visit_hex(self, node, visited_children):
+        return int(node.text[2:], 16)
+
+    def visit_number(self, node, visited_children):
+        return int(node.text)
+
+    def visit_id(self, node, visited_children):
+        return ID(node.text)
+
+    def visit_arg(self, node, visited_children):
+        return [Arg(node.start, visited_children[1][0])]
+
+    def visit_args(self, node, visited_children):
+        if len(visited_children[0]) == 1:
+            return visited_children[0]
+        return visited_children[0][0] + visited_children[0][2]
+
+    def visit_definition(self, node, visited_children):
+        id, _, args, _ = visited_children
+        try:
+            if isinstance(args, list):
+                return components[id.name](node.start, args[0])
+            return components[id.name](node.start, [])
+        except KeyError:
+            self.raise_error(ProfileEntryError(node.start, f'Unknown definition name "{id.name}"'))
+
+    def visit_assignment(self, node, visited_children):
+        id, _, definition = visited_children
+        return Assignment(self.source, node.start, id.name, definition)
+
+    def visit_board(self, node, visited_children):
+        _, _, id = visited_children
+        return Board(self.source, node.start, id)
+
+    def visit_line(self, node, visited_children):
+        return visited_children[1][0]
+
+    def generic_visit(self, node, visited_children):
+        """ The generic visit method. """
+        return visited_children or node
+
+
+def parse(source):
+    """Parses source with the grammar, returning the node tree and the entries visited from it."""
+    try:
+        tree = grammar.parse(source.text)
+    except ParseError as e:
+        raise ProfileParseError(e.pos)
+    visitor = ProfileVisitor(source)
+    try:
+        return tree, visitor.visit(tree)
+    except VisitationError:
+        if visitor.error is not None:
+            source.errors = [visitor.error]
+            raise visitor.error
+        raise
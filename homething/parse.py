@@ -1,29 +1,10 @@
-import yaml
-import os.path
-
-from parsimonious.grammar import Grammar
-from parsimonious.nodes import NodeVisitor
-from parsimonious.exceptions import VisitationError
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+import re
 
 from .encode import *
-
-grammar = Grammar(r"""
-start      = line* 
-line       = ws? (definition / assignment / board) ws?
-id         = ~"[a-z_][a-z0-9_]*"i
-number     = ~"-?[0-9]+"
-hex        = ~"0x[0-9a-f]+"i
-ws         = ~"\s*"
-lpar       = "("
-rpar       = ")"
-equal      =  ws? "=" ws?
-str        = ~'"[^\"]+"'
-arg        = ws? ( definition / id / str / hex/ number) ws?
-args       =  (arg "," args) / arg 
-definition = id "(" args? ")"
-board      = "%board:" ws? id
-assignment = id equal definition 
-""")
+from . import registry
 
 
 class Assignment:
@@ -35,10 +16,12 @@ class Assignment:
 
     def process(self, id_table, profile):
         if self.id in id_table:
-            self.source.print_message_for_location(self.pos, "warning", f'Duplicate id "{self.id}"')
+            self.source.add_diagnostic(self.pos, "warning", f'Duplicate id "{self.id}"')
 
         id_table[self.id] = len(profile) - 1
-        self.call.process(id_table, profile)
+        # An unknown definition has already been reported, the id is still defined so its uses are not reported too
+        if self.call is not None:
+            self.call.process(id_table, profile)
 
     def __str__(self):
         return f"Assign({self.id}, {self.call})"
@@ -57,92 +40,179 @@ class Board:
             raise ProfileEntryError(self.id.pos, f"Unknown board name {self.id.name}")
 
 
-class ProfileVisitor(NodeVisitor):
-    def __init__(self, source):
-        super().__init__()
-        self.source = source
-        self.error = None
-
-    def raise_error(self, error):
-        self.error = error
-        raise error
-
-    def visit_start(self, node, visited_children):
-        return visited_children
-
-    def visit_str(self, node, visited_children):
-        return node.text[1:-1]
+ws_re = re.compile(r"\s*")
+id_re = re.compile(r"[a-z_][a-z0-9_]*", re.IGNORECASE)
+number_re = re.compile(r"-?[0-9]+")
+hex_re = re.compile(r"0x[0-9a-f]+", re.IGNORECASE)
+str_re = re.compile(r'"[^\"]+"')
 
-    def visit_hex(self, node, visited_children):
-        return int(node.text[2:], 16)
 
-    def visit_number(self, node, visited_children):
-        return int(node.text)
+class ProfileParser:
+    """Single pass recursive descent parser accepting the same language as homething.grammar and producing the same
+    entries as its ProfileVisitor.
 
-    def visit_id(self, node, visited_children):
-        return ID(node.text)
+    Each rule method takes the position to start matching at and returns a (value, end) tuple, or None if the rule
+    does not match. A definition only fails to match once its "(" has been seen, after which the line can not match
+    either, so nothing built for a failed alternative ends up in the entries of a profile that parses.
+    """
 
-    def visit_arg(self, node, visited_children):
-        return [Arg(node.start, visited_children[1][0])]
-
-    def visit_args(self, node, visited_children):
-        if len(visited_children[0]) == 1:
-            return visited_children[0]
-        return visited_children[0][0] + visited_children[0][2]
+    def __init__(self, source):
+        self.source = source
+        self.text = source.text
+        self.errors = []
 
-    def visit_definition(self, node, visited_children):
-        id, _, args, _ = visited_children
+    def parse(self):
+        entries = []
+        pos = 0
+        end = len(self.text)
+        while pos < end:
+            result = self.line(pos)
+            if result is None:
+                self.errors = []
+                raise ProfileParseError(pos)
+            entry, pos = result
+            entries.append(entry)
+        return entries
+
+    def skip_ws(self, pos):
+        return ws_re.match(self.text, pos).end()
+
+    def line(self, pos):
+        pos = self.skip_ws(pos)
+        result = self.definition(pos) or self.assignment(pos) or self.board(pos)
+        if result is None:
+            return None
+        entry, pos = result
+        return entry, self.skip_ws(pos)
+
+    def definition(self, pos):
+        text = self.text
+        match = id_re.match(text, pos)
+        if match is None or not text.startswith("(", match.end()):
+            return None
+        args_start = match.end() + 1
+        result = self.args(args_start)
+        if result is None:
+            args, end = [], args_start
+        else:
+            args, end = result
+        if not text.startswith(")", end):
+            return None
+        name = match.group()
         try:
-            if isinstance(args, list):
-                return components[id.name](node.start, args[0])
-            return components[id.name](node.start, [])
+            component = components[name](pos, args)
         except KeyError:
-            self.raise_error(ProfileEntryError(node.start, f'Unknown definition name "{id.name}"'))
-
-    def visit_assignment(self, node, visited_children):
-        id, _, definition = visited_children
-        return Assignment(self.source, node.start, id.name, definition)
-
-    def visit_board(self, node, visited_children):
-        _, _, id = visited_children
-        return Board(self.source, node.start, id)
-
-    def visit_line(self, node, visited_children):
-        return visited_children[1][0]
-
-    def generic_visit(self, node, visited_children):
-        """ The generic visit method. """
-        return visited_children or node
+            component = None
+            self.errors.append(ProfileEntryError(pos, f'Unknown definition name "{name}"'))
+        return component, end + 1
+
+    def args(self, pos):
+        args = []
+        while True:
+            result = self.arg(pos)
+            if result is None:
+                # Matches the grammar falling back to the args matched before the last ","
+                return (args, pos - 1) if args else None
+            arg, end = result
+            args.append(arg)
+            if not self.text.startswith(",", end):
+                return args, end
+            pos = end + 1
+
+    def arg(self, pos):
+        text = self.text
+        value_start = self.skip_ws(pos)
+        result = self.definition(value_start)
+        if result is None:
+            match = id_re.match(text, value_start)
+            if match is not None:
+                result = ID(match.group()), match.end()
+            else:
+                match = str_re.match(text, value_start)
+                if match is not None:
+                    result = match.group()[1:-1], match.end()
+                else:
+                    match = hex_re.match(text, value_start)
+                    if match is not None:
+                        result = int(match.group()[2:], 16), match.end()
+                    else:
+                        match = number_re.match(text, value_start)
+                        if match is None:
+                            return None
+                        result = int(match.group()), match.end()
+        value, end = result
+        return Arg(pos, value), self.skip_ws(end)
+
+    def assignment(self, pos):
+        match = id_re.match(self.text, pos)
+        if match is None:
+            return None
+        equal = self.skip_ws(match.end())
+        if not self.text.startswith("=", equal):
+            return None
+        result = self.definition(self.skip_ws(equal + 1))
+        if result is None:
+            return None
+        definition, end = result
+        return Assignment(self.source, pos, match.group(), definition), end
+
+    def board(self, pos):
+        if not self.text.startswith("%board:", pos):
+            return None
+        match = id_re.match(self.text, self.skip_ws(pos + len("%board:")))
+        if match is None:
+            return None
+        return Board(self.source, pos, ID(match.group())), match.end()
+
+
+Diagnostic = namedtuple('Diagnostic', ('location', 'type', 'message'))
 
 
 class ProfileSource:
-    def __init__(self):
+    def __init__(self, use_grammar=False):
         self.text = ""
         self.filename = ""
+        self.use_grammar = use_grammar
         self.tree = None
+        self.entries = None
+        self.errors = []
+        self.diagnostics = []
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+        self._line_starts = None
+
+    @property
+    def line_starts(self):
+        """Offsets of the start of each line, built when first needed."""
+        if self._line_starts is None:
+            line_starts = [0]
+            line_starts.extend(accumulate(len(line) + 1 for line in self._text.split('\n')[:-1]))
+            self._line_starts = line_starts
+        return self._line_starts
 
     def load(self, filename):
         self.filename = filename
         with open(filename) as f:
             self.text = f.read()
 
+    def line_and_column(self, location):
+        """Returns the line and column numbers, both starting at 1, of location."""
+        line_no = bisect_right(self.line_starts, location)
+        return line_no, location - self.line_starts[line_no - 1] + 1
+
     def message_for_location(self, location, message_type, message):
-        start_of_line = self.text.rfind('\n', 0, location)
-        end_of_line = self.text.find('\n', location)
-        if start_of_line == -1:
-            start_of_line = 0
-            line_no = 1
+        line_starts = self.line_starts
+        line_no = bisect_right(line_starts, location)
+        start_of_line = line_starts[line_no - 1]
+        if line_no < len(line_starts):
+            end_of_line = line_starts[line_no] - 1
         else:
-            start_of_line += 1
-            line_no = 1
-            index = 0
-            while index < start_of_line:
-                index = self.text.find('\n', index + 1)
-                if index == -1:
-                    break
-                line_no += 1
-
-        if end_of_line == -1:
             end_of_line = len(self.text)
         line = self.text[start_of_line:end_of_line]
         indent = ' ' * (location - start_of_line)
@@ -153,26 +223,66 @@ class ProfileSource:
 
         return f'{prefix}{line_no}: {message_type}: {message}\n{line}\n{indent}^'
 
-    def print_message_for_location(self, location, message_type, message):
-        print(self.message_for_location(location, message_type, message))
+    def add_diagnostic(self, location, message_type, message):
+        self.diagnostics.append(Diagnostic(location, message_type, message))
+
+    def format_diagnostics(self):
+        return '\n'.join(self.message_for_location(*diagnostic) for diagnostic in self.diagnostics)
 
     def parse(self):
-        self.tree = grammar.parse(self.text)
+        """Parses the profile into entries, raising the first error. Unknown definitions are parsed as None, so when
+        only those are found entries is still set."""
+        self.errors = []
+        self.entries = None
+        if self.use_grammar:
+            # The grammar is slow to import and build, so only load it when it is used
+            from . import grammar
+            self.tree, self.entries = grammar.parse(self)
+        else:
+            parser = ProfileParser(self)
+            try:
+                self.entries = parser.parse()
+            finally:
+                self.errors = parser.errors
+            # The visitor only runs once the whole profile has parsed, so unknown definitions are reported after any
+            # parse error.
+            if self.errors:
+                raise self.errors[0]
 
     def process(self):
         id_table = {}
         profile = [1]
-        visitor = ProfileVisitor(self)
-        try:
-            for entry in visitor.visit(self.tree):
-                entry.process(id_table, profile)
-        except VisitationError:
-            if visitor.error is not None:
-                raise visitor.error
-            raise
+        for entry in self.entries:
+            entry.process(id_table, profile)
         return profile
 
+    def compile(self):
+        """Parses and processes the profile, collecting every diagnostic in diagnostics rather than stopping at the
+        first error. Returns the profile, or None if there were any errors.
+
+        Parsing stops at a syntax error, otherwise every unknown definition name and every entry that fails to
+        process is reported."""
+        self.diagnostics = []
+        try:
+            self.parse()
+        except ProfileEntryError as e:
+            for error in self.errors or [e]:
+                self.add_diagnostic(error.location, 'error', error.message)
+            if self.entries is None:
+                return None
+
+        id_table = {}
+        profile = [1]
+        failed = bool(self.errors)
+        for entry in self.entries:
+            if entry is None:
+                continue
+            try:
+                entry.process(id_table, profile)
+            except ProfileEntryError as e:
+                self.add_diagnostic(e.location, 'error', e.message)
+                failed = True
+        return None if failed else profile
 
-with open(os.path.join(os.path.dirname(__file__), "boards.yaml")) as fp:
-    boards = yaml.safe_load(fp)
+boards = registry.boards
 
@@ -0,0 +1,88 @@
+"""Component and board definitions shared by the encoder, decoder and parser.
+
+components.yaml and boards.yaml are loaded once per process. The loaded definitions are also kept in a pickled
+snapshot so later processes can skip YAML parsing. The snapshot is used while the size and mtime of both YAML files
+match, and if either has changed, while their content hashes still match.
+"""
+import hashlib
+import os
+import os.path
+import pickle
+
+SOURCE_DIR = os.path.dirname(__file__)
+SOURCES = ("components.yaml", "boards.yaml")
+SNAPSHOT_PATH = os.path.join(SOURCE_DIR, "__pycache__", "registry.pickle")
+SNAPSHOT_VERSION = 1
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def source_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_yaml(path):
+    import yaml
+
+    with open(path) as fp:
+        return yaml.safe_load(fp)
+
+
+def load_snapshot(paths):
+    try:
+        with open(SNAPSHOT_PATH, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or set(snapshot['sources']) != set(SOURCES):
+        return None
+
+    stale = [name for name, path in paths.items() if snapshot['sources'][name]['stat'] != source_stat(path)]
+    if stale:
+        # Checking out or copying the files changes their mtime without changing their content
+        for name in stale:
+            if snapshot['sources'][name]['hash'] != source_hash(paths[name]):
+                return None
+            snapshot['sources'][name]['stat'] = source_stat(paths[name])
+        save_snapshot(snapshot)
+    return snapshot
+
+
+def save_snapshot(snapshot):
+    # The package directory may not be writable, the snapshot is only an optimisation
+    try:
+        os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+        temp_path = f"{SNAPSHOT_PATH}.{os.getpid()}"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, SNAPSHOT_PATH)
+    except OSError:
+        pass
+
+
+def build_snapshot(paths):
+    sources = {}
+    for name, path in paths.items():
+        # Stat before reading so a change while loading invalidates the snapshot next time
+        stat = source_stat(path)
+        sources[name] = dict(stat=stat, hash=source_hash(path))
+    snapshot = dict(version=SNAPSHOT_VERSION, sources=sources,
+                    components=load_yaml(paths["components.yaml"]), boards=load_yaml(paths["boards.yaml"]))
+    save_snapshot(snapshot)
+    return snapshot
+
+
+def load():
+    paths = {name: os.path.join(SOURCE_DIR, name) for name in SOURCES}
+    return load_snapshot(paths) or build_snapshot(paths)
+
+
+_snapshot = load()
+
+components = _snapshot['components']
+boards = _snapshot['boards']
+definitions_hash = hashlib.sha256(''.join(_snapshot['sources'][name]['hash'] for name in SOURCES).encode()).digest()
@@ -0,0 +1,218 @@
+"""Incremental validation of profile sources for interactive editing.
+
+ProfileValidator keeps the parse of every line of the text it last validated, and the id_table entries each line
+looked up and set when it was processed. After an edit, unchanged lines are not parsed again and only the lines that
+changed are processed. Lines after them are processed again only if they look up an id_table entry, an id or the
+board pins, whose value the edit changed.
+
+Lines are parsed on their own, which matches parsing the whole text as long as every line holds complete entries.
+The diagnostics are always the same as from ProfileSource.compile(). When a line does not parse on its own, the
+position of the syntax error is found by parsing from the start of that line. If an entry is split over several
+lines the whole text is compiled instead.
+"""
+from operator import attrgetter
+
+from .parse import ProfileSource, ProfileParser, ProfileEntryError, ProfileParseError, Diagnostic, ws_re
+
+MISSING = object()
+
+
+class RecordingIdTable:
+    """Wraps an id_table, recording the values a line looked up before setting them itself and the values it set."""
+
+    def __init__(self, table):
+        self.table = table
+        self.lookups = {}
+        self.writes = {}
+
+    def record(self, key):
+        if key not in self.writes and key not in self.lookups:
+            self.lookups[key] = self.table.get(key, MISSING)
+
+    def __getitem__(self, key):
+        self.record(key)
+        return self.table[key]
+
+    def __contains__(self, key):
+        self.record(key)
+        return key in self.table
+
+    def __setitem__(self, key, value):
+        self.writes[key] = value
+        self.table[key] = value
+
+
+class ParsedLine:
+    """The entries of a line, or the unknown definition errors in it, with locations relative to the start of the
+    line. Lines with the same text share a ParsedLine."""
+
+    def __init__(self, text):
+        self.source = ProfileSource()
+        self.source.text = text
+        self.parsed = True
+        self.entries = []
+        self.errors = []
+        if ws_re.fullmatch(text):
+            return
+        try:
+            self.source.parse()
+            self.entries = self.source.entries
+        except ProfileParseError:
+            self.parsed = False
+        except ProfileEntryError:
+            # Unknown definitions are parsed as None
+            self.entries = self.source.entries
+            self.errors = self.source.errors
+
+
+class ValidatedLine:
+    """The result of processing a line at a position in the profile."""
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+        self.lookups = {}
+        self.writes = {}
+        self.diagnostics = []
+
+    def process(self, table):
+        source = self.parsed.source
+        source.diagnostics = []
+        recording = RecordingIdTable(table)
+        profile = [1]
+        for entry in self.parsed.entries:
+            if entry is None:
+                continue
+            try:
+                entry.process(recording, profile)
+            except ProfileEntryError as e:
+                source.add_diagnostic(e.location, 'error', e.message)
+        self.lookups = recording.lookups
+        self.writes = recording.writes
+        self.diagnostics = source.diagnostics
+
+
+class ProfileValidator:
+    def __init__(self):
+        self.parsed_lines = {}
+        # Lines of the last text that was processed, validating text with errors leaves them unchanged.
+        self.lines = []
+        self.validated = []
+        self.processed_lines = 0
+
+    def parse_lines(self, lines):
+        parsed_lines = self.parsed_lines
+        if len(parsed_lines) > 2 * (len(lines) + len(self.lines)) + 100:
+            # Forget lines that have been edited away
+            previous = parsed_lines
+            self.parsed_lines = parsed_lines = {text: previous[text] for text in self.lines if text in previous}
+        parsed = list(map(parsed_lines.get, lines))
+        if None in parsed:
+            for index, text in enumerate(lines):
+                if parsed[index] is None:
+                    parsed[index] = parsed_lines[text] = ParsedLine(text)
+        return parsed
+
+    def validate(self, text):
+        """Validates text, returning a ProfileSource for the text, to locate and format the diagnostics with, and the
+        diagnostics."""
+        source = ProfileSource()
+        source.text = text
+        lines = text.split('\n')
+        parsed = self.parse_lines(lines)
+        self.processed_lines = 0
+        line_starts = source.line_starts
+
+        if not all(map(attrgetter('parsed'), parsed)):
+            has_entries = False
+            for index, line in enumerate(parsed):
+                if not line.parsed:
+                    break
+                has_entries = has_entries or bool(line.entries or line.errors)
+            location = self.find_parse_error(source, index, has_entries)
+            if location is None:
+                source.compile()
+                return source, source.diagnostics
+            return source, [Diagnostic(location, 'error', 'Failed to parse')]
+
+        if text and not any(map(attrgetter('entries'), parsed)):
+            # Whitespace only profiles fail to parse as a whole
+            return source, [Diagnostic(0, 'error', 'Failed to parse')]
+
+        self.process(lines, parsed)
+        # Unknown definitions are reported before the diagnostics from processing, as by compile()
+        diagnostics = []
+        if any(map(attrgetter('errors'), parsed)):
+            for line, start in zip(parsed, line_starts):
+                diagnostics.extend(Diagnostic(start + error.location, 'error', error.message) for error in line.errors)
+        for line, start in zip(self.validated, line_starts):
+            if line.diagnostics:
+                diagnostics.extend(Diagnostic(start + location, message_type, message)
+                                   for location, message_type, message in line.diagnostics)
+        return source, diagnostics
+
+    def find_parse_error(self, source, index, has_previous_entries):
+        """Returns the location of the syntax error when the line at index does not parse on its own, or None if it
+        is part of an entry split over several lines."""
+        parser = ProfileParser(source)
+        line_starts = source.line_starts
+        end = line_starts[index + 1] if index + 1 < len(line_starts) else len(source.text)
+        # Whitespace after an entry is part of it, so parsing the whole text would stop after it
+        pos = parser.skip_ws(line_starts[index]) if has_previous_entries else 0
+        while True:
+            result = parser.line(pos)
+            if result is None:
+                return pos
+            _, pos = result
+            if pos >= end:
+                return None
+
+    def process(self, lines, parsed):
+        old_lines = self.lines
+        old_validated = self.validated
+        common = min(len(lines), len(old_lines))
+        prefix = 0
+        while prefix < common and lines[prefix] == old_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < common - prefix and lines[-1 - suffix] == old_lines[-1 - suffix]:
+            suffix += 1
+
+        table = {}
+        for line in old_validated[:prefix]:
+            table.update(line.writes)
+        old_table = dict(table)
+
+        changed_keys = set()
+        for line in old_validated[prefix:len(old_validated) - suffix]:
+            old_table.update(line.writes)
+            changed_keys.update(line.writes)
+        changed = []
+        for line in parsed[prefix:len(parsed) - suffix]:
+            line = ValidatedLine(line)
+            line.process(table)
+            changed_keys.update(line.writes)
+            changed.append(line)
+        self.processed_lines = len(changed)
+
+        # Only lines looking up a value that differs from when they were last processed need processing again
+        dirty = {key for key in changed_keys if old_table.get(key, MISSING) != table.get(key, MISSING)}
+        unchanged = old_validated[len(old_validated) - suffix:]
+        for line in unchanged:
+            if not dirty:
+                break
+            old_writes = line.writes
+            old_table.update(old_writes)
+            if dirty.isdisjoint(line.lookups):
+                table.update(old_writes)
+                dirty.difference_update(old_writes)
+                continue
+            line.process(table)
+            self.processed_lines += 1
+            for key in old_writes.keys() | line.writes.keys():
+                if old_table.get(key, MISSING) != table.get(key, MISSING):
+                    dirty.add(key)
+                else:
+                    dirty.discard(key)
+
+        self.lines = lines
+        self.validated = old_validated[:prefix] + changed + unchanged
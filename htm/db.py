@@ -1,9 +1,19 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, func, select, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import asyncio
 import datetime
+import logging
+import math
+import threading
+import time
 import pytz
 
+logger = logging.getLogger("db")
+
 engine = create_engine('sqlite:///homething.db')
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
@@ -27,38 +37,393 @@ class MemoryLog(Base):
     min_free = Column(Integer)
 
 
+class MemoryRollup(Base):
+    __tablename__ = "memoryrollups"
+    device = Column(String, primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)  # Start of the bucket in seconds since the epoch
+    count = Column(Integer)
+    free_min = Column(Integer)
+    free_max = Column(Integer)
+    free_sum = Column(Integer)
+    min_free_min = Column(Integer)
+    min_free_max = Column(Integer)
+    min_free_sum = Column(Integer)
+
+    @property
+    def free_avg(self):
+        return self.free_sum / self.count
+
+    @property
+    def min_free_avg(self):
+        return self.min_free_sum / self.count
+
+
 Base.metadata.create_all(engine)
 
+MEMORY_LOG_INTERVAL = 30  # Devices send a heart beat every 30 seconds.
+MEMORY_ROLLUP_RESOLUTIONS = (60, 15 * 60, 60 * 60)
 
-def add_memory_log(device, free, min_free):
-    now = datetime.datetime.now(pytz.utc)
-    log = MemoryLog(datetime=now, device=device, free=free, min_free=min_free)
+
+class WriteBehindBuffer:
+    """Collects rows in memory so they can be written in a single transaction. add() reports when max_rows are
+    pending and is_due() when the oldest pending row is older than max_age seconds. Rows from a failed write are kept
+    to be written by the next flush, while SQLite is unavailable at most max_retained rows are kept and the oldest
+    are dropped."""
+    SLOW_FLUSH_THRESHOLD = 0.5
+
+    def __init__(self, max_rows=500, max_age=5.0, max_retained=None):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_retained = 10 * max_rows if max_retained is None else max_retained
+        self.lock = threading.Lock()
+        self.pending = defaultdict(list)
+        self.flush_hooks = defaultdict(list)
+        self.depth = 0
+        self.oldest = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+
+    def add(self, model, **row):
+        with self.lock:
+            self.pending[model].append(row)
+            self.depth += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            return self.depth >= self.max_rows
+
+    def add_flush_hook(self, model, hook):
+        self.flush_hooks[model].append(hook)
+
+    def is_due(self):
+        oldest = self.oldest
+        return oldest is not None and time.monotonic() - oldest >= self.max_age
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+            depth, self.depth = self.depth, 0
+            oldest, self.oldest = self.oldest, None
+        if depth == 0:
+            return
+
+        start = time.monotonic()
+        session = Session()
+        try:
+            for model, rows in pending.items():
+                session.bulk_insert_mappings(model, rows)
+                for hook in self.flush_hooks[model]:
+                    hook(session, rows)
+            session.commit()
+        except:
+            session.rollback()
+            self.restore(pending, depth, oldest)
+            logger.error("Failed to write %d rows", depth)
+            raise
+        finally:
+            session.close()
+
+        duration = time.monotonic() - start
+        self.flushes += 1
+        self.rows_written += depth
+        self.last_flush_duration = duration
+        self.max_flush_duration = max(self.max_flush_duration, duration)
+        if duration > self.SLOW_FLUSH_THRESHOLD:
+            logger.warning("Writing %d rows took %.3fs", depth, duration)
+
+    def restore(self, pending, depth, oldest):
+        """Puts the rows of a failed flush back ahead of the rows added since."""
+        with self.lock:
+            for model, rows in pending.items():
+                self.pending[model][:0] = rows
+            self.depth += depth
+            self.oldest = oldest
+            self.failed_flushes += 1
+            dropped = max(0, self.depth - self.max_retained)
+            excess = dropped
+            for rows in self.pending.values():
+                if excess == 0:
+                    break
+                count = min(excess, len(rows))
+                del rows[:count]
+                excess -= count
+            self.depth -= dropped
+            self.dropped_rows += dropped
+        if dropped:
+            logger.error("Dropped %d unwritten rows", dropped)
+
+    def stats(self):
+        oldest = self.oldest
+        return dict(depth=self.depth,
+                    oldest_age=0 if oldest is None else time.monotonic() - oldest,
+                    flushes=self.flushes,
+                    failed_flushes=self.failed_flushes,
+                    dropped_rows=self.dropped_rows,
+                    rows_written=self.rows_written,
+                    last_flush_duration=self.last_flush_duration,
+                    max_flush_duration=self.max_flush_duration)
+
+
+def update_memory_rollups(session, logs):
+    rollups = {}
+    for log in logs:
+        timestamp = int(log['datetime'].timestamp())
+        for resolution in MEMORY_ROLLUP_RESOLUTIONS:
+            key = (log['device'], resolution, timestamp - timestamp % resolution)
+            rollup = rollups.get(key)
+            if rollup is None:
+                device, resolution, bucket = key
+                rollups[key] = dict(device=device, resolution=resolution, bucket=bucket, count=1,
+                                    free_min=log['free'], free_max=log['free'], free_sum=log['free'],
+                                    min_free_min=log['min_free'], min_free_max=log['min_free'],
+                                    min_free_sum=log['min_free'])
+            else:
+                rollup['count'] += 1
+                rollup['free_min'] = min(rollup['free_min'], log['free'])
+                rollup['free_max'] = max(rollup['free_max'], log['free'])
+                rollup['free_sum'] += log['free']
+                rollup['min_free_min'] = min(rollup['min_free_min'], log['min_free'])
+                rollup['min_free_max'] = max(rollup['min_free_max'], log['min_free'])
+                rollup['min_free_sum'] += log['min_free']
+
+    stmt = sqlite_insert(MemoryRollup)
+    existing = MemoryRollup.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[existing.device, existing.resolution, existing.bucket],
+        set_=dict(count=existing.count + stmt.excluded.count,
+                  free_min=func.min(existing.free_min, stmt.excluded.free_min),
+                  free_max=func.max(existing.free_max, stmt.excluded.free_max),
+                  free_sum=existing.free_sum + stmt.excluded.free_sum,
+                  min_free_min=func.min(existing.min_free_min, stmt.excluded.min_free_min),
+                  min_free_max=func.max(existing.min_free_max, stmt.excluded.min_free_max),
+                  min_free_sum=existing.min_free_sum + stmt.excluded.min_free_sum))
+    session.execute(stmt, list(rollups.values()))
+
+
+def backfill_memory_rollups():
     session = Session()
     try:
-        session.add(log)
+        if session.query(MemoryRollup.device).first() is not None:
+            return
+        timestamp = func.cast(func.strftime('%s', MemoryLog.datetime), Integer)
+        for resolution in MEMORY_ROLLUP_RESOLUTIONS:
+            bucket = timestamp - timestamp % resolution
+            query = select(MemoryLog.device, literal(resolution), bucket, func.count(),
+                           func.min(MemoryLog.free), func.max(MemoryLog.free), func.sum(MemoryLog.free),
+                           func.min(MemoryLog.min_free), func.max(MemoryLog.min_free), func.sum(MemoryLog.min_free)
+                           ).group_by(MemoryLog.device, bucket)
+            columns = ['device', 'resolution', 'bucket', 'count', 'free_min', 'free_max', 'free_sum',
+                       'min_free_min', 'min_free_max', 'min_free_sum']
+            session.execute(MemoryRollup.__table__.insert().from_select(columns, query))
         session.commit()
     except:
         session.rollback()
         raise
+    finally:
+        session.close()
+
+
+write_buffer = WriteBehindBuffer()
+write_buffer.add_flush_hook(MemoryLog, update_memory_rollups)
+
+
+def buffer_memory_log(device, free, min_free):
+    now = datetime.datetime.now(pytz.utc)
+    return write_buffer.add(MemoryLog, datetime=now, device=device, free=free, min_free=min_free)
+
+
+def add_memory_log(device, free, min_free):
+    if buffer_memory_log(device, free, min_free):
+        write_buffer.flush()
 
 
 def get_memory_logs(device, from_time, to_time):
+    write_buffer.flush()
     return Session().query(MemoryLog).filter(MemoryLog.device == device, MemoryLog.datetime >= from_time,
                                              MemoryLog.datetime <= to_time).order_by(MemoryLog.datetime.asc())
 
 
-def add_event(device, event, uptime):
-    timestamp = datetime.datetime.now(pytz.utc)
-    log = Event(datetime=timestamp, device=device, event=event, uptime=uptime)
+MemoryStat = namedtuple("MemoryStat", ["timestamp", "free", "free_min", "free_max", "min_free"])
+
+
+def choose_memory_source(bucket_size):
+    source = 0
+    for resolution in MEMORY_ROLLUP_RESOLUTIONS:
+        if resolution <= bucket_size:
+            source = resolution
+    return source
+
+
+def get_memory_stats(device, from_time, to_time, max_points):
+    """Returns the bucket size in seconds (0 for raw logs) and a list of MemoryStat with at most max_points entries,
+    timestamps are in seconds since the epoch. When the range holds more than max_points heart beats the logs are
+    grouped into buckets in SQL, reading from the coarsest rollup that fits the bucket size. free is the average of
+    the bucket, min_free the minimum."""
+    from_timestamp = int(from_time.timestamp())
+    to_timestamp = int(to_time.timestamp())
+    seconds = to_timestamp - from_timestamp
+    if seconds / MEMORY_LOG_INTERVAL <= max_points:
+        return 0, [MemoryStat(int(log.datetime.replace(tzinfo=pytz.utc).timestamp()), log.free, log.free, log.free,
+                              log.min_free)
+                   for log in get_memory_logs(device, from_time, to_time)]
+
+    write_buffer.flush()
+    bucket_size = max(1, math.ceil(seconds / max_points))
+    source = choose_memory_source(bucket_size)
+    if source == 0:
+        timestamp = func.cast(func.strftime('%s', MemoryLog.datetime), Integer)
+        bucket = (timestamp - timestamp % bucket_size).label("bucket")
+        query = select(bucket, func.sum(MemoryLog.free), func.count(), func.min(MemoryLog.free),
+                       func.max(MemoryLog.free), func.min(MemoryLog.min_free)
+                       ).where(MemoryLog.device == device, MemoryLog.datetime >= from_time,
+                               MemoryLog.datetime <= to_time)
+    else:
+        bucket_size = math.ceil(bucket_size / source) * source
+        bucket = (MemoryRollup.bucket - MemoryRollup.bucket % bucket_size).label("bucket")
+        query = select(bucket, func.sum(MemoryRollup.free_sum), func.sum(MemoryRollup.count),
+                       func.min(MemoryRollup.free_min), func.max(MemoryRollup.free_max),
+                       func.min(MemoryRollup.min_free_min)
+                       ).where(MemoryRollup.device == device, MemoryRollup.resolution == source,
+                               MemoryRollup.bucket >= from_timestamp - from_timestamp % source,
+                               MemoryRollup.bucket <= to_timestamp)
+
     session = Session()
     try:
-        session.add(log)
-        session.commit()
-    except:
-        session.rollback()
-        raise
+        rows = session.execute(query.group_by(bucket).order_by(bucket)).all()
+    finally:
+        session.close()
+    return bucket_size, [MemoryStat(timestamp, round(free_sum / count), free_min, free_max, min_free)
+                         for timestamp, free_sum, count, free_min, free_max, min_free in rows]
+
+
+def memory_trend(n, sum_x, sum_y, sum_xy, sum_xx):
+    # Least squares slope, NULL when all points are at the same time.
+    return (n * sum_xy - sum_x * sum_y) / func.nullif(n * sum_xx - sum_x * sum_x, 0)
+
+
+FLEET_MEMORY_SORT_COLUMNS = ('device', 'free', 'min_free', 'lowest_free', 'lowest_min_free', 'free_trend',
+                             'min_free_trend', 'updated')
+
+
+def get_fleet_memory_stats(from_time, to_time, sort='lowest_min_free', descending=False, offset=0, limit=50):
+    """Returns the total number of devices with memory logs between from_time and to_time and a page of their
+    latest, lowest and trend (bytes per hour, least squares) of free and min_free in a single query."""
+    hours = (func.julianday(MemoryLog.datetime) - func.julianday(literal(from_time, DateTime))) * 24
+    aggregates = select(MemoryLog.device.label('device'),
+                        func.max(MemoryLog.datetime).label('updated'),
+                        func.min(MemoryLog.free).label('lowest_free'),
+                        func.min(MemoryLog.min_free).label('lowest_min_free'),
+                        memory_trend(func.count(), func.sum(hours), func.sum(MemoryLog.free),
+                                     func.sum(hours * MemoryLog.free), func.sum(hours * hours)).label('free_trend'),
+                        memory_trend(func.count(), func.sum(hours), func.sum(MemoryLog.min_free),
+                                     func.sum(hours * MemoryLog.min_free), func.sum(hours * hours)
+                                     ).label('min_free_trend')
+                        ).where(MemoryLog.datetime >= from_time, MemoryLog.datetime <= to_time
+                                ).group_by(MemoryLog.device).subquery()
+    latest = MemoryLog.__table__.alias('latest')
+    columns = dict(device=aggregates.c.device, free=latest.c.free, min_free=latest.c.min_free,
+                   lowest_free=aggregates.c.lowest_free, lowest_min_free=aggregates.c.lowest_min_free,
+                   free_trend=aggregates.c.free_trend, min_free_trend=aggregates.c.min_free_trend,
+                   updated=aggregates.c.updated)
+    order = columns[sort].desc() if descending else columns[sort].asc()
+    query = select(*[column.label(name) for name, column in columns.items()], func.count().over().label('total')
+                   ).join_from(aggregates, latest, (latest.c.device == aggregates.c.device) &
+                               (latest.c.datetime == aggregates.c.updated)
+                               ).order_by(order, aggregates.c.device).offset(offset).limit(limit)
+
+    write_buffer.flush()
+    session = Session()
+    try:
+        rows = session.execute(query).all()
+    finally:
+        session.close()
+    total = rows[0].total if rows else 0
+    return total, [{name: getattr(row, name) for name in columns} for row in rows]
+
+
+def buffer_event(device, event, uptime):
+    timestamp = datetime.datetime.now(pytz.utc)
+    return write_buffer.add(Event, datetime=timestamp, device=device, event=event, uptime=uptime)
+
+
+def add_event(device, event, uptime):
+    if buffer_event(device, event, uptime):
+        write_buffer.flush()
 
 
 def get_events_query(device):
+    write_buffer.flush()
     return Session().query().select_from(Event).filter_by(device=device)
 
+
+class AsyncDatabase:
+    """Runs the database operations on a single dedicated thread so the event loop is never blocked by SQLite.
+    At most max_pending operations are queued on the thread, further callers wait for a free slot."""
+
+    def __init__(self, max_pending=32):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.max_pending = max_pending
+        self.slots = None
+        self.pending = 0
+        self.flushing = False
+
+    async def run(self, func, *args):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_pending)
+        async with self.slots:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            finally:
+                self.pending -= 1
+
+    def add_memory_log(self, device, free, min_free):
+        if buffer_memory_log(device, free, min_free):
+            self.flush()
+
+    def add_event(self, device, event, uptime):
+        if buffer_event(device, event, uptime):
+            self.flush()
+
+    def flush(self):
+        if not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self._flush())
+
+    def flush_if_due(self):
+        if write_buffer.is_due():
+            self.flush()
+
+    async def _flush(self):
+        try:
+            await self.run(write_buffer.flush)
+        except Exception:
+            logger.error("Failed to flush write buffer", exc_info=True)
+        finally:
+            self.flushing = False
+
+    async def get_memory_logs(self, device, from_time, to_time):
+        return await self.run(lambda: get_memory_logs(device, from_time, to_time).all())
+
+    async def get_memory_stats(self, device, from_time, to_time, max_points):
+        return await self.run(get_memory_stats, device, from_time, to_time, max_points)
+
+    async def get_fleet_memory_stats(self, from_time, to_time, sort, descending, offset, limit):
+        return await self.run(get_fleet_memory_stats, from_time, to_time, sort, descending, offset, limit)
+
+    async def get_events_query(self, device, execute):
+        return await self.run(lambda: execute(get_events_query(device)))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        write_buffer.flush()
+
+    def stats(self):
+        return dict(pending=self.pending, max_pending=self.max_pending, flushing=self.flushing)
+
+
+async_db = AsyncDatabase()
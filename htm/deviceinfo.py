@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import List
+from typing import List, Tuple
 from dataclasses import dataclass
 from enum import IntEnum
 
@@ -37,11 +37,48 @@ class TopicInfo:
 @dataclass(frozen=True)
 class TopicEntry:
     path: str
-    pubs: List[TopicInfo]
-    subs: List[TopicInfo]
+    pubs: Tuple[TopicInfo, ...]
+    subs: Tuple[TopicInfo, ...]
+
+    def __post_init__(self):
+        object.__setattr__(self, '_hash', hash((self.path,) + tuple(self.pubs) + tuple(self.subs)))
 
     def __hash__(self):
-        return hash((self.path,) + tuple(self.pubs) + tuple(self.subs))
+        return self._hash
 
     def _to_json(self):
         return dict(path=self.path, pubs=self.pubs, subs=self.subs)
+
+
+class TopicCatalog:
+    """Process wide store of topic descriptions, devices running the same firmware publish identical description
+    tables so they share the same immutable TopicInfo tuples, TopicEntry objects and entry lists."""
+
+    def __init__(self):
+        self.infos = {}
+        self.entries = {}
+        self.entry_lists = {}
+
+    def get_infos(self, topics_dict) -> Tuple[TopicInfo, ...]:
+        key = tuple(topics_dict.items())
+        infos = self.infos.get(key)
+        if infos is None:
+            infos = self.infos[key] = tuple(TopicInfo.list_from_dict(topics_dict))
+        return infos
+
+    def get_entry(self, path, pubs, subs) -> TopicEntry:
+        key = (path, pubs, subs)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = TopicEntry(path, pubs, subs)
+        return entry
+
+    def get_entries(self, topics) -> Tuple[TopicEntry, ...]:
+        descriptions = {description_id: (self.get_infos(raw_pubs), self.get_infos(raw_subs))
+                        for description_id, (raw_pubs, raw_subs) in topics[0].items()}
+        entries = tuple(self.get_entry(name, *descriptions[description_id])
+                        for name, description_id in topics[1].items())
+        return self.entry_lists.setdefault(entries, entries)
+
+
+catalog = TopicCatalog()
@@ -1,74 +1,110 @@
 from __future__ import annotations
-from collections import defaultdict
+from collections import Counter
+import asyncio
+import heapq
+import itertools
 import logging
+import sys
 import json
 import time
 import datetime
 import humanize
 import cbor2
-from homething.decode import decode as decode_profile
-from .db import add_memory_log, add_event
-from .deviceinfo import TopicInfo, TopicEntry
+from homething.decode import decode_cbor as decode_profile
+from .db import async_db
+from .deviceinfo import catalog as topic_catalog
 from htm import notifications
 
 logger = logging.getLogger("devices")
 
 
-class AttributeAccessDictionary(dict):
-    def __getattr__(self, item):
-        if item in self.keys():
-            return self.get(item)
-        raise AttributeError(f"No such item: {item}")
+def intern_strings(values):
+    return {sys.intern(key): sys.intern(value) if isinstance(value, str) else value for key, value in values.items()}
+
+
+class TopicRoute:
+    """The result of parsing a topic, cached by Devices so repeated messages on a topic go straight to the handler."""
+    __slots__ = ('device', 'path', 'handler', 'properties', 'key', 'topic', 'changes_summary', 'deletes_device',
+                 'skip_unchanged', 'payload_hash')
+
+    def __init__(self, device, path, handler, properties=None, key=None, topic=None, changes_summary=False,
+                 deletes_device=False, skip_unchanged=False):
+        self.device = device
+        self.path = path
+        self.handler = handler
+        # For property topics, the device's dictionary and key the value is stored under and the notified path
+        self.properties = properties
+        self.key = key
+        self.topic = topic
+        self.changes_summary = changes_summary
+        self.deletes_device = deletes_device
+        # Hash of the last payload handled, used to skip payloads that are republished unchanged
+        self.skip_unchanged = skip_unchanged
+        self.payload_hash = None
 
 
 class Device:
     ALIVE_UPTIME_THRESHOLD = 30 * 3  # Allow upto 2 missed heart beats.
     MAX_EVENTS = 1000
 
+    DEVICE_HANDLERS = dict(info='_process_info', diag='_process_diag_message', profile='_process_profile',
+                           topics='_process_topics', status='_process_status')
+    # Device paths that are republished on every reconnect, identical payloads are ignored
+    SKIP_UNCHANGED_PATHS = frozenset(('info', 'topics', 'profile'))
+
+    __slots__ = ('devices', 'uuid', 'properties', 'online', 'last_uptime_update', 'last_uptime', 'info', 'task_stats',
+                 'profile', 'status', 'entries', 'current_free', 'current_min_free', 'retained_topics', 'version',
+                 'online_deadline')
+
     def __init__(self, devices, uuid):
         self.devices = devices
         self.uuid = uuid
-        self.properties = defaultdict(AttributeAccessDictionary)
+        self.properties = {}
         self.online = False
         self.last_uptime_update = 0
         self.last_uptime = 0
         self.info = {}
-        self.diag = {}
         self.task_stats = []
         self.profile = ''
         self.status = ''
-        self.entries = []
+        self.entries = ()
         self.current_free = None
         self.current_min_free = None
+        # Topic paths are interned as most devices share the same set of paths
         self.retained_topics = set()
+        self.version = 0
+        self.online_deadline = None
 
-    def update_property(self, prop_path, value, retain):
-        if retain:
-            self.retained_topics.add('/'.join(prop_path))
-            if value == b'':
-                return
-
+    def create_route(self, prop_path):
+        path = sys.intern('/'.join(prop_path))
         if prop_path[0] == 'device':
-            self._process_device(prop_path[1], value)
+            name = prop_path[1] if len(prop_path) > 1 else ''
+            handler = self.DEVICE_HANDLERS.get(name)
+            return TopicRoute(self, path, None if handler is None else getattr(Device, handler),
+                              changes_summary=name in Devices.SUMMARY_PATHS, deletes_device=name == 'uptime',
+                              skip_unchanged=name in self.SKIP_UNCHANGED_PATHS)
+
+        properties = self.properties.get(prop_path[0])
+        if properties is None:
+            properties = self.properties[sys.intern(prop_path[0])] = {}
+        if len(prop_path) == 1:
+            key = 'default'
+            topic = sys.intern(prop_path[0])
         else:
-
-            if len(prop_path) == 1:
-                self.properties[prop_path[0]]['default'] = value.decode()
-                topic = prop_path[0]
-                value = self.properties[prop_path[0]]['default']
-
-            else:
-                try:
-                    self.properties[prop_path[0]][prop_path[1]] = value.decode()
-                except UnicodeDecodeError:
-                    try:
-                        self.properties[prop_path[0]][prop_path[1]] = cbor2.loads(value)
-                    except (cbor2.CBORDecodeError, UnicodeDecodeError):
-                        self.properties[prop_path[0]][prop_path[1]] = value
-                topic = f'{prop_path[0]}/{prop_path[1]}'
-                value = self.properties[prop_path[0]][prop_path[1]]
-
-            notifications.manager.send_notification(self, "topic", dict(path=topic, value=value))
+            key = sys.intern(prop_path[1])
+            topic = sys.intern(f'{prop_path[0]}/{prop_path[1]}')
+        return TopicRoute(self, path, Device._set_property, properties, key, topic)
+
+    def _set_property(self, route, value):
+        try:
+            value = value.decode()
+        except UnicodeDecodeError:
+            try:
+                value = cbor2.loads(value)
+            except (cbor2.CBORDecodeError, UnicodeDecodeError):
+                pass
+        route.properties[route.key] = value
+        notifications.manager.send_notification(self, "topic", dict(path=route.topic, value=value))
 
     def is_alive(self):
         now = time.time()
@@ -76,40 +112,40 @@ class Device:
 
     def check_online(self):
         now = time.time()
-        if self.online and now - self.last_uptime_update > self.ALIVE_UPTIME_THRESHOLD:
+        if self.online and now >= self.last_uptime_update + self.ALIVE_UPTIME_THRESHOLD:
             self.online = False
             self.add_event("offline", self.last_uptime)
             notifications.manager.send_notification(self, "online", False)
-
-    def _process_device(self, path, value):
-        if path == 'info':
-            try:
-                self.info = json.loads(value.decode())
-                notifications.manager.send_notification(self, "info", self.info)
-            except (UnicodeDecodeError, json.JSONDecodeError):
-                logger.error("Failed to parse %r as JSON", value, exc_info=True)
-
-        if path == 'diag':
-            try:
-                self.diag = json.loads(value.decode())
-                self._process_diag(self.diag)
-                notifications.manager.send_notification(self, "diag", self.diag)
-            except (UnicodeDecodeError, json.JSONDecodeError):
-                logger.error("Failed to parse %r as JSON", value, exc_info=True)
-
-        elif path == 'profile':
-            profile_data = cbor2.loads(value)
-            self.profile = decode_profile(profile_data)
-            notifications.manager.send_notification(self, "profile", self.profile)
-
-        elif path == 'topics':
-            topics_data = cbor2.loads(value)
-            self.process_topics(topics_data)
-            notifications.manager.send_notification(self, "topics", self.entries)
-
-        elif path == 'status':
-            self.status = value.decode()
-            notifications.manager.send_notification(self, "status", self.status)
+            return True
+        return False
+
+    def _process_info(self, route, value):
+        try:
+            self.info = intern_strings(json.loads(value.decode()))
+            notifications.manager.send_notification(self, "info", self.info)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            logger.error("Failed to parse %r as JSON", value, exc_info=True)
+
+    def _process_diag_message(self, route, value):
+        try:
+            diag = json.loads(value.decode())
+            self._process_diag(diag)
+            notifications.manager.send_notification(self, "diag", diag)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            logger.error("Failed to parse %r as JSON", value, exc_info=True)
+
+    def _process_profile(self, route, value):
+        self.profile = sys.intern(decode_profile(value))
+        notifications.manager.send_notification(self, "profile", self.profile)
+
+    def _process_topics(self, route, value):
+        topics_data = cbor2.loads(value)
+        self.process_topics(topics_data)
+        notifications.manager.send_notification(self, "topics", self.entries)
+
+    def _process_status(self, route, value):
+        self.status = sys.intern(value.decode())
+        notifications.manager.send_notification(self, "status", self.status)
 
     def _process_diag(self, diag):
         new_uptime = diag.get("uptime", 0)
@@ -124,42 +160,35 @@ class Device:
 
         self.last_uptime = new_uptime
         self.last_uptime_update = time.time()
+        self.devices.schedule_online_check(self, self.last_uptime_update + self.ALIVE_UPTIME_THRESHOLD)
         notifications.manager.send_notification(self, "uptime", dict(uptime=new_uptime, updated=self.last_uptime_update))
 
         if 'mem' in diag:
             memory = diag['mem']
             mem_free = memory['free']
             mem_low = memory['low']
-            add_memory_log(self.uuid, mem_free, mem_low)
+            self.current_free = mem_free
+            self.current_min_free = mem_low
+            async_db.add_memory_log(self.uuid, mem_free, mem_low)
             notifications.manager.send_notification(self, "memory", dict(mem_free=mem_free, mem_low=mem_low))
 
         if 'tasks' in diag:
-            self.task_stats = [(task['name'], task['stackMinLeft']) for task in diag['tasks']]
+            self.task_stats = [(sys.intern(task['name']), task['stackMinLeft']) for task in diag['tasks']]
             notifications.manager.send_notification(self, "taskStats", self.task_stats)
 
-    def __getattr__(self, item):
-        if item in self.properties:
-            return self.properties[item]
-        raise AttributeError(f"No such property: {item}")
+    def summary(self):
+        return {"id": self.uuid, "uptime": self.last_uptime, "version": self.info.get('version', ''),
+                "online": self.online, "description": self.info.get("description", "")}
 
     @property
     def uptime_str(self):
         return humanize.precisedelta(datetime.timedelta(seconds=self.last_uptime))
 
     def process_topics(self, topics):
-        self.entries = []
-
-        descriptions = {}
-        for description_id, (raw_pubs, raw_subs) in topics[0].items():
-            descriptions[description_id] = (TopicInfo.list_from_dict(raw_pubs), TopicInfo.list_from_dict(raw_subs))
-
-        for name, description_id in topics[1].items():
-            pubs, subs = descriptions[description_id]
-            entry = TopicEntry(name, pubs, subs)
-            self.entries.append(entry)
+        self.entries = topic_catalog.get_entries(topics)
 
     def add_event(self, event, uptime):
-        add_event(self.uuid, event, uptime)
+        async_db.add_event(self.uuid, event, uptime)
 
     async def set_profile(self, profile):
         topic = f'homething/{self.uuid}/device/ctrl'
@@ -169,9 +198,12 @@ class Device:
         topic = f'homething/{self.uuid}/device/ctrl'
         await self.devices.mqtt.send_message(topic, b'restart')
 
-    async def update(self, version):
+    async def update(self, version, firmware_url=None):
+        """Tells the device to update to version, downloading the image from firmware_url, the URL of the directory
+        holding the images, when given rather than from its configured update server."""
         topic = f'homething/{self.uuid}/device/ctrl'
-        await self.devices.mqtt.send_message(topic, b'update ' + version.encode())
+        command = f'update {version}' if firmware_url is None else f'update {version} {firmware_url}'
+        await self.devices.mqtt.send_message(topic, command.encode())
 
     async def delete(self):
         for topic_path in self.retained_topics:
@@ -186,21 +218,91 @@ class Device:
 
 
 class Devices:
+    # Device paths that change the device summary
+    SUMMARY_PATHS = frozenset(('info', 'diag'))
+    # Removed device ids remembered for incremental changes, older removals need a full list
+    MAX_REMOVED = 1000
+
     def __init__(self):
         self.devices = {}
         self.mqtt = None
+        # The version is bumped whenever a device summary changes, the instance id makes ETags from a previous run
+        # invalid.
+        self.instance_id = f"{int(time.time() * 1000):x}"
+        self.version = 0
+        # Removed device id to the version it was removed in, oldest first, and the newest version forgotten
+        self.removed = {}
+        self.removed_floor = 0
+        self.snapshot_version = None
+        self.snapshot = None
+        # Heap of (deadline, sequence, device), entries are left in place when a device is rescheduled and skipped
+        # when they expire if the device has a newer deadline.
+        self.online_deadlines = []
+        self.online_deadline_sequence = itertools.count()
+        self.online_deadline_timer = None
+        # Topic to TopicRoute
+        self.routes = {}
+        self.skipped_messages = Counter()
+
+    def _changed(self, device):
+        self.version += 1
+        device.version = self.version
+
+    def process_message(self, topic, value, retain):
+        route = self.routes.get(topic)
+        if route is None:
+            route = self._create_route(topic, value)
+            if route is None:
+                return
 
-    def update_device(self, uuid, prop_path, value, retain):
+        if route.deletes_device and value == b'':
+            self._remove_device(route.device)
+            return
+
+        if retain:
+            route.device.retained_topics.add(route.path)
+            if value == b'':
+                return
+        if route.handler is not None:
+            if route.skip_unchanged:
+                payload_hash = hash(value)
+                if payload_hash == route.payload_hash:
+                    self.skipped_messages[route.path] += 1
+                    return
+                route.payload_hash = payload_hash
+            route.handler(route.device, route, value)
+            if route.changes_summary:
+                self._changed(route.device)
+
+    def _create_route(self, topic, value):
+        topic_elements = topic.split('/')
+        uuid = topic_elements[1]
+        prop_path = topic_elements[2:]
         device = self.devices.get(uuid)
         if device is None:
             if prop_path == ['device', 'uptime'] and value == b'':
-                return
-            device = Device(self, uuid)
-            self.devices[uuid] = device
+                return None
+            device = Device(self, sys.intern(uuid))
+            self.devices[device.uuid] = device
+            self.removed.pop(uuid, None)
+            self._changed(device)
+
+        route = device.create_route(prop_path)
+        self.routes[sys.intern(topic)] = route
+        return route
+
+    def _remove_device(self, device):
+        del self.devices[device.uuid]
+        self.routes = {topic: route for topic, route in self.routes.items() if route.device is not device}
+        self.version += 1
+        self.removed[device.uuid] = self.version
+        while len(self.removed) > self.MAX_REMOVED:
+            uuid = next(iter(self.removed))
+            self.removed_floor = self.removed.pop(uuid)
+        notifications.manager.send_notification(device, "deleted", True)
 
-        if prop_path == ['device', 'uptime'] and value == b'':
-            del self.devices[uuid]
-        device.update_property(prop_path, value, retain)
+    def update_device(self, uuid, prop_path, value, retain):
+        self.process_message(f"homething/{uuid}/{'/'.join(prop_path)}", value, retain)
 
     def get_device(self, uuid):
         return self.devices.get(uuid)
@@ -208,8 +310,52 @@ class Devices:
     def get_devices(self):
         return self.devices.values()
 
-    def check_devices_online(self):
-        for device in self.devices.values():
-            device.check_online()
-
-
+    @property
+    def version_token(self):
+        return f"{self.instance_id}-{self.version}"
+
+    def get_snapshot(self):
+        """Returns the ETag for the current version and the serialized summaries of all devices."""
+        if self.snapshot_version != self.version:
+            self.snapshot = json.dumps({"version": self.version_token,
+                                        "devices": [device.summary() for device in self.devices.values()]}).encode()
+            self.snapshot_version = self.version
+        return f'"{self.version_token}"', self.snapshot
+
+    def get_changes(self, since):
+        """Returns the devices changed and the ids removed since the version token given. When the changes cannot be
+        worked out, because the token is from a previous run or older than the removals remembered, all devices are
+        returned with full set to true so the client replaces its list. Raises ValueError if the token is malformed."""
+        instance_id, _, version = since.rpartition('-')
+        version = int(version)
+        if instance_id != self.instance_id or version > self.version or version < self.removed_floor:
+            return {"version": self.version_token, "full": True,
+                    "devices": [device.summary() for device in self.devices.values()], "removed": []}
+        return {"version": self.version_token, "full": False,
+                "devices": [device.summary() for device in self.devices.values() if device.version > version],
+                "removed": [uuid for uuid, removed in self.removed.items() if removed > version]}
+
+    def schedule_online_check(self, device, deadline):
+        device.online_deadline = deadline
+        heapq.heappush(self.online_deadlines, (deadline, next(self.online_deadline_sequence), device))
+        if self.online_deadlines[0][2] is device:
+            self._start_online_deadline_timer()
+
+    def _start_online_deadline_timer(self):
+        if self.online_deadline_timer is not None:
+            self.online_deadline_timer.cancel()
+            self.online_deadline_timer = None
+        if self.online_deadlines:
+            delay = max(0.0, self.online_deadlines[0][0] - time.time())
+            self.online_deadline_timer = asyncio.get_event_loop().call_later(delay, self._check_online_deadlines)
+
+    def _check_online_deadlines(self):
+        self.online_deadline_timer = None
+        now = time.time()
+        while self.online_deadlines and self.online_deadlines[0][0] <= now:
+            deadline, _, device = heapq.heappop(self.online_deadlines)
+            if device.online_deadline != deadline or self.devices.get(device.uuid) is not device:
+                continue
+            if device.check_online():
+                self._changed(device)
+        self._start_online_deadline_timer()
@@ -83,9 +83,7 @@ class AIOMqttHandler(MQTTHandler):
                 return
 
     def process_message(self, message):
-        topic_elements = message.topic_name.split('/')
-        uuid = topic_elements[1]
-        self.db.update_device(uuid, topic_elements[2:], message.payload.decode(), message.retain)
+        self.db.process_message(message.topic_name, message.payload.decode(), message.retain)
 
     async def send_message(self, topic, message, retain=False):
         await self._client.publish(aio_mqtt.PublishableMessage(topic, message, retain=retain))
@@ -110,9 +108,7 @@ class AsyncioMqttHandler(MQTTHandler):
         self.connect()
 
     def process_message(self, message):
-        topic_elements = message.topic.split('/')
-        uuid = topic_elements[1]
-        self.db.update_device(uuid, topic_elements[2:], message.payload, message.retain)
+        self.db.process_message(message.topic, message.payload, message.retain)
 
     async def send_message(self, topic, message, retain=False):
         await self.client.publish(topic, message, retain=retain)
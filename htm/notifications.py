@@ -1,26 +1,139 @@
-from collections import defaultdict
+import asyncio
+import inspect
+import logging
+from collections import deque
+
+logger = logging.getLogger("notifications")
+
+# Events where only the latest value matters, if one is still waiting to be delivered it is replaced.
+COALESCED_EVENTS = frozenset(("uptime", "memory", "diag", "taskStats"))
+_COALESCED = object()
+
+
+class QueuedListener:
+    """Delivers notifications to a listener from its own task so a slow listener never delays the sender. The
+    listener may return an awaitable which is waited on before the next notification is delivered. At most max_size
+    notifications are queued, when full the oldest is dropped. Listeners that cannot lose notifications pass
+    on_overflow instead, which is called once when the queue is full, after which the queue is emptied and further
+    notifications are ignored."""
+
+    def __init__(self, listener, max_size=100, on_overflow=None):
+        self.listener = listener
+        self.max_size = max_size
+        self.on_overflow = on_overflow
+        self.overflowed = False
+        self.pending = deque()
+        self.latest = {}
+        self.task = None
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __call__(self, device, event, data):
+        if self.overflowed:
+            return
+        if event in COALESCED_EVENTS:
+            key = (device, event)
+            if key in self.latest:
+                self.latest[key] = data
+                self.coalesced += 1
+                return
+            self.latest[key] = data
+            data = _COALESCED
+
+        if len(self.pending) >= self.max_size and self.on_overflow is not None:
+            self.overflowed = True
+            self.pending.clear()
+            self.latest.clear()
+            self.on_overflow()
+            return
+        if len(self.pending) >= self.max_size:
+            dropped_device, dropped_event, dropped_data = self.pending.popleft()
+            if dropped_data is _COALESCED:
+                del self.latest[(dropped_device, dropped_event)]
+            self.dropped += 1
+        self.pending.append((device, event, data))
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._deliver())
+
+    async def _deliver(self):
+        try:
+            while self.pending:
+                device, event, data = self.pending.popleft()
+                if data is _COALESCED:
+                    data = self.latest.pop((device, event))
+                try:
+                    result = self.listener(device, event, data)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception:
+                    logger.error("Listener %r failed for %s", self.listener, event, exc_info=True)
+        finally:
+            self.task = None
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.pending.clear()
+        self.latest.clear()
 
 
 class NotificationsManager:
     def __init__(self):
-        self.device_listeners = defaultdict(list)
-        self.all_listeners = []
+        # Listener tuples are replaced rather than modified so they can be iterated without copying.
+        self.device_listeners = {}
+        self.all_listeners = ()
+        # QueuedListeners created by create_queue, counted in the stats along with the totals of released ones
+        self.queues = set()
+        self.released_coalesced = 0
+        self.released_dropped = 0
+        self.released_overflowed = 0
+
+    def create_queue(self, listener, max_size=100, on_overflow=None):
+        """Returns a QueuedListener delivering to listener, it must be released with release_queue."""
+        queue = QueuedListener(listener, max_size, on_overflow)
+        self.queues.add(queue)
+        return queue
+
+    def release_queue(self, queue):
+        queue.close()
+        self.queues.discard(queue)
+        self.released_coalesced += queue.coalesced
+        self.released_dropped += queue.dropped
+        self.released_overflowed += queue.overflowed
 
     def add_device_listener(self, device, listener):
-        self.device_listeners[device].append(listener)
+        self.device_listeners[device] = self.device_listeners.get(device, ()) + (listener,)
 
     def remove_device_listener(self, device, listener):
-        self.device_listeners[device].remove(listener)
+        listeners = list(self.device_listeners[device])
+        listeners.remove(listener)
+        if listeners:
+            self.device_listeners[device] = tuple(listeners)
+        else:
+            del self.device_listeners[device]
 
     def add_listener(self, listener):
-        self.all_listeners.append(listener)
+        self.all_listeners = self.all_listeners + (listener,)
 
     def remove_listener(self, listener):
-        self.all_listeners.remove(listener)
+        listeners = list(self.all_listeners)
+        listeners.remove(listener)
+        self.all_listeners = tuple(listeners)
 
     def send_notification(self, device, event, data):
-        for listener in self.device_listeners[device] + self.all_listeners:
+        for listener in self.device_listeners.get(device, ()):
+            listener(device, event, data)
+        for listener in self.all_listeners:
             listener(device, event, data)
 
+    def stats(self):
+        queues = self.queues
+        return dict(queued_listeners=len(queues),
+                    pending=sum(len(queue.pending) for queue in queues),
+                    coalesced=self.released_coalesced + sum(queue.coalesced for queue in queues),
+                    dropped=self.released_dropped + sum(queue.dropped for queue in queues),
+                    overflowed=self.released_overflowed + sum(queue.overflowed for queue in queues))
+
 
 manager = NotificationsManager()
@@ -0,0 +1,140 @@
+import datetime
+import logging
+import time
+import pytz
+from sqlalchemy import literal_column, select
+from htm import db
+
+logger = logging.getLogger("retention")
+
+rowid = literal_column("rowid")
+
+
+class RetentionPolicy:
+    def __init__(self, name, table, max_age):
+        self.name = name
+        self.table = table
+        self.max_age = max_age
+
+    def expired(self, now):
+        raise NotImplementedError('expired needs to be implemented by subclass')
+
+
+class DateTimeRetentionPolicy(RetentionPolicy):
+    def expired(self, now):
+        return self.table.c.datetime < now - self.max_age
+
+
+class RollupRetentionPolicy(RetentionPolicy):
+    def __init__(self, name, resolution, max_age):
+        super().__init__(name, db.MemoryRollup.__table__, max_age)
+        self.resolution = resolution
+
+    def expired(self, now):
+        cutoff = int((now - self.max_age).timestamp())
+        return (self.table.c.resolution == self.resolution) & (self.table.c.bucket < cutoff)
+
+
+# Default number of days to keep the memory rollups of each resolution for
+ROLLUP_RETENTION_DAYS = {60: 7, 15 * 60: 90, 60 * 60: 2 * 365}
+
+
+def rollup_policy_name(resolution):
+    if resolution % (60 * 60) == 0:
+        return f"memoryrollups_{resolution // (60 * 60)}h"
+    return f"memoryrollups_{resolution // 60}m"
+
+
+def get_policies(memory_log_max_age, event_max_age, rollup_max_ages=None):
+    """rollup_max_ages maps rollup resolutions in seconds to their maximum age, defaulting to ROLLUP_RETENTION_DAYS."""
+    if rollup_max_ages is None:
+        rollup_max_ages = {resolution: datetime.timedelta(days=days)
+                           for resolution, days in ROLLUP_RETENTION_DAYS.items()}
+    return [DateTimeRetentionPolicy("memorylogs", db.MemoryLog.__table__, memory_log_max_age),
+            DateTimeRetentionPolicy("events", db.Event.__table__, event_max_age)] + \
+        [RollupRetentionPolicy(rollup_policy_name(resolution), resolution, max_age)
+         for resolution, max_age in rollup_max_ages.items()]
+
+
+def delete_chunk(table, condition, chunk_size):
+    expired = select(rowid).select_from(table).where(condition).limit(chunk_size)
+    with db.engine.begin() as connection:
+        return connection.execute(table.delete().where(rowid.in_(expired))).rowcount
+
+
+def compact(pages, enable_incremental_vacuum):
+    """Reclaims up to pages free pages and returns True, or returns False when the database is not in incremental
+    auto vacuum mode. Switching to it needs a full VACUUM, which holds the write lock for as long as it takes to
+    rewrite the database, so it is only done when enable_incremental_vacuum is set."""
+    with db.engine.connect() as connection:
+        incremental = connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+        if not incremental and enable_incremental_vacuum:
+            # Switching to incremental mode only takes effect after a full vacuum, this only happens once.
+            logger.info("Enabling incremental vacuum")
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+            incremental = True
+        if incremental:
+            connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+        connection.exec_driver_sql("PRAGMA optimize")
+        return incremental
+
+
+class RetentionManager:
+    """Deletes rows older than each policy allows, a chunk at a time so that the SQLite write lock is only held
+    briefly and buffered writes can be interleaved, then reclaims free pages and refreshes the query planner stats."""
+
+    def __init__(self, policies, chunk_size=1000, vacuum_pages=2000, enable_incremental_vacuum=False):
+        self.policies = policies
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.enable_incremental_vacuum = enable_incremental_vacuum
+        self.incremental_vacuum = None
+        self.running = False
+        self.last_run = None
+        self.last_deleted = {}
+        self.last_duration = 0.0
+        self.last_compact_duration = 0.0
+        self.total_deleted = 0
+
+    async def run(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            start = time.monotonic()
+            now = datetime.datetime.now(pytz.utc)
+            deleted = {}
+            for policy in self.policies:
+                condition = policy.expired(now)
+                deleted[policy.name] = 0
+                while True:
+                    count = await db.async_db.run(delete_chunk, policy.table, condition, self.chunk_size)
+                    deleted[policy.name] += count
+                    if count < self.chunk_size:
+                        break
+
+            compact_start = time.monotonic()
+            incremental_vacuum = await db.async_db.run(compact, self.vacuum_pages, self.enable_incremental_vacuum)
+            if not incremental_vacuum and self.incremental_vacuum is None:
+                logger.warning("Free pages are not being reclaimed, start with --enable_incremental_vacuum to switch "
+                               "the database to incremental vacuum with a one off full VACUUM")
+            self.incremental_vacuum = incremental_vacuum
+            end = time.monotonic()
+
+            self.last_run = time.time()
+            self.last_deleted = deleted
+            self.last_duration = end - start
+            self.last_compact_duration = end - compact_start
+            self.total_deleted += sum(deleted.values())
+            logger.info("Deleted %d expired rows %r in %.3fs (compaction %.3fs)", sum(deleted.values()), deleted,
+                        self.last_duration, self.last_compact_duration)
+        except Exception:
+            logger.error("Retention run failed", exc_info=True)
+        finally:
+            self.running = False
+
+    def stats(self):
+        return dict(last_run=self.last_run, last_deleted=self.last_deleted, last_duration=self.last_duration,
+                    last_compact_duration=self.last_compact_duration, total_deleted=self.total_deleted,
+                    incremental_vacuum=self.incremental_vacuum)
@@ -0,0 +1,264 @@
+"""Staged firmware rollouts to a set of devices.
+
+A rollout updates its devices in waves. Waves start wave_interval seconds after the previous wave has finished, and
+at most concurrency devices in a wave are updating at a time. A device has been updated when it reports the new
+version in its info. It has failed if it is still running another version restart_grace seconds after it restarted,
+or if neither happens within timeout seconds. Devices republishing the same info after restarting on their old
+firmware are not notified again, so the version is checked in the device's info rather than waiting for one.
+
+When the proportion of failed updates reaches failure_threshold the rollout is paused, devices already updating are
+still followed but no more are started until it is resumed.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from htm import notifications
+from htm.updates import get_flash_type
+
+logger = logging.getLogger("rollout")
+
+ACTIVE_STATES = frozenset(('running', 'paused'))
+
+
+def select_devices(devices, catalog, version, flash_type=None, from_version=None):
+    """Returns the online devices that have an image of version for their flash, filtered by flash type and current
+    version when given, excluding devices already running version."""
+    selected = []
+    for device in devices.get_devices():
+        capabilities = device.info.get('capabilities')
+        current_version = device.info.get('version')
+        if not device.online or capabilities is None or current_version == version:
+            continue
+        if from_version and current_version != from_version:
+            continue
+        device_flash_type = get_flash_type(capabilities)
+        if flash_type and device_flash_type != flash_type:
+            continue
+        if version in catalog.get_versions_for_flash(device_flash_type):
+            selected.append(device)
+    return selected
+
+
+class RolloutDevice:
+    __slots__ = ('device', 'from_version', 'state', 'message', 'started', 'finished', 'result')
+
+    def __init__(self, device):
+        self.device = device
+        self.from_version = device.info.get('version', '')
+        # pending, updating, restarting, succeeded, failed, skipped or cancelled
+        self.state = 'pending'
+        self.message = None
+        self.started = None
+        self.finished = None
+        self.result = None
+
+    def _to_json(self):
+        return dict(id=self.device.uuid, from_version=self.from_version, state=self.state, message=self.message,
+                    started=self.started, finished=self.finished)
+
+
+class Rollout:
+    def __init__(self, rollout_id, version, devices, firmware_url=None, concurrency=5, wave_size=20, wave_interval=60.0,
+                 timeout=300.0, failure_threshold=0.2, min_results=5, restart_grace=15.0):
+        if concurrency < 1 or wave_size < 1:
+            raise ValueError("Concurrency and wave size must be at least 1")
+        if not 0 < failure_threshold <= 1:
+            raise ValueError("Failure threshold must be greater than 0 and at most 1")
+        self.id = rollout_id
+        self.version = version
+        self.firmware_url = firmware_url
+        self.entries = [RolloutDevice(device) for device in devices]
+        self.concurrency = concurrency
+        self.wave_size = wave_size
+        self.wave_interval = wave_interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.min_results = min_results
+        self.restart_grace = restart_grace
+        # running, paused, cancelled or finished
+        self.state = 'running'
+        self.pause_reason = None
+        self.created = time.time()
+        self.wave = 0
+        self.succeeded = 0
+        self.failed = 0
+        # Device to RolloutDevice for the devices being updated
+        self.in_flight = {}
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.task = None
+
+    @property
+    def waves(self):
+        return (len(self.entries) + self.wave_size - 1) // self.wave_size
+
+    def start(self):
+        notifications.manager.add_listener(self.on_notification)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        try:
+            for start in range(0, len(self.entries), self.wave_size):
+                if start:
+                    await asyncio.sleep(self.wave_interval)
+                self.wave += 1
+                updates = []
+                for entry in self.entries[start:start + self.wave_size]:
+                    await self.resumed.wait()
+                    await slots.acquire()
+                    while not self.resumed.is_set():
+                        # Paused while waiting for a slot
+                        slots.release()
+                        await self.resumed.wait()
+                        await slots.acquire()
+                    updates.append(asyncio.ensure_future(self.update(entry, slots)))
+                await asyncio.gather(*updates)
+            self.state = 'finished'
+        except asyncio.CancelledError:
+            self.state = 'cancelled'
+        except Exception:
+            logger.error("Rollout %d of %s failed", self.id, self.version, exc_info=True)
+            self.state = 'cancelled'
+        finally:
+            notifications.manager.remove_listener(self.on_notification)
+            for entry in self.entries:
+                if entry.state == 'pending':
+                    entry.state = 'cancelled'
+
+    async def update(self, entry, slots):
+        device = entry.device
+        try:
+            if not device.online:
+                self.finish(entry, 'skipped', "Offline")
+                return
+            entry.state = 'updating'
+            entry.started = time.time()
+            entry.result = asyncio.get_running_loop().create_future()
+            self.in_flight[device] = entry
+            await device.update(self.version, self.firmware_url)
+            state, message = await asyncio.wait_for(entry.result, self.timeout)
+            self.finish(entry, state, message)
+        except asyncio.TimeoutError:
+            self.finish(entry, 'failed', f"Timed out while {entry.state}")
+        except asyncio.CancelledError:
+            self.finish(entry, 'cancelled', None)
+            raise
+        except Exception as e:
+            logger.error("Failed to update %s to %s", device.uuid, self.version, exc_info=True)
+            self.finish(entry, 'failed', str(e))
+        finally:
+            self.in_flight.pop(device, None)
+            slots.release()
+
+    def on_notification(self, device, event, data):
+        entry = self.in_flight.get(device)
+        if entry is None or entry.result is None or entry.result.done():
+            return
+        if event == 'info':
+            version = data.get('version')
+            if version == self.version:
+                entry.result.set_result(('succeeded', None))
+            elif entry.state == 'restarting':
+                entry.result.set_result(('failed', f"Restarted with version {version}"))
+        elif event == 'online':
+            # Devices go offline to apply an update
+            entry.state = 'restarting'
+        elif event == 'reboot':
+            entry.state = 'restarting'
+            # Allow time for the device to publish its info after connecting
+            asyncio.get_running_loop().call_later(self.restart_grace, self.check_version, entry)
+        elif event == 'deleted':
+            entry.result.set_result(('failed', "Deleted"))
+
+    def check_version(self, entry):
+        if entry.result.done():
+            return
+        version = entry.device.info.get('version')
+        if version == self.version:
+            entry.result.set_result(('succeeded', None))
+        else:
+            entry.result.set_result(('failed', f"Restarted with version {version}"))
+
+    def finish(self, entry, state, message):
+        entry.state = state
+        entry.message = message
+        entry.finished = time.time()
+        if state == 'succeeded':
+            self.succeeded += 1
+        elif state == 'failed':
+            self.failed += 1
+            logger.warning("Update of %s to %s failed: %s", entry.device.uuid, self.version, message)
+            results = self.succeeded + self.failed
+            if (self.state == 'running' and results >= self.min_results and
+                    self.failed / results >= self.failure_threshold):
+                self.pause(f"{self.failed} of {results} updates failed")
+
+    def pause(self, reason=None):
+        if self.state == 'running':
+            self.state = 'paused'
+            self.pause_reason = reason
+            self.resumed.clear()
+
+    def resume(self):
+        if self.state == 'paused':
+            self.state = 'running'
+            self.pause_reason = None
+            self.resumed.set()
+
+    def cancel(self):
+        if self.state in ACTIVE_STATES:
+            self.task.cancel()
+
+    def counts(self):
+        counts = dict.fromkeys(('pending', 'updating', 'restarting', 'succeeded', 'failed', 'skipped', 'cancelled'), 0)
+        for entry in self.entries:
+            counts[entry.state] += 1
+        return counts
+
+    def _to_json(self):
+        return dict(id=self.id, version=self.version, state=self.state, pause_reason=self.pause_reason,
+                    created=self.created, wave=self.wave, waves=self.waves, concurrency=self.concurrency,
+                    wave_size=self.wave_size, wave_interval=self.wave_interval, timeout=self.timeout,
+                    failure_threshold=self.failure_threshold, counts=self.counts(),
+                    devices=[entry._to_json() for entry in self.entries])
+
+
+class RolloutManager:
+    """Starts rollouts and keeps the most recent ones. Only one rollout runs at a time so its concurrency limits the
+    updates across the whole fleet."""
+
+    def __init__(self, devices, updates, max_rollouts=20):
+        self.devices = devices
+        self.updates = updates
+        self.max_rollouts = max_rollouts
+        self.rollouts = {}
+        self.rollout_ids = itertools.count(1)
+
+    def start(self, version, firmware_url=None, flash_type=None, from_version=None, **options):
+        if self.updates.updates_dir is None:
+            raise ValueError("No updates directory has been configured")
+        if any(rollout.state in ACTIVE_STATES for rollout in self.rollouts.values()):
+            raise ValueError("Another rollout is in progress")
+        devices = select_devices(self.devices, self.updates.get_catalog(), version, flash_type, from_version)
+        if not devices:
+            raise ValueError(f"No online devices need updating to {version}")
+
+        rollout = Rollout(next(self.rollout_ids), version, devices, firmware_url, **options)
+        self.rollouts[rollout.id] = rollout
+        while len(self.rollouts) > self.max_rollouts:
+            del self.rollouts[next(iter(self.rollouts))]
+        rollout.start()
+        logger.info("Started rollout %d of %s to %d devices", rollout.id, version, len(devices))
+        return rollout
+
+    def get_rollout(self, rollout_id):
+        return self.rollouts.get(rollout_id)
+
+    def get_rollouts(self):
+        return self.rollouts.values()
+
+    def stats(self):
+        return dict(rollouts=len(self.rollouts),
+                    active=sum(rollout.state in ACTIVE_STATES for rollout in self.rollouts.values()))
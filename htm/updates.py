@@ -1,32 +1,142 @@
+import asyncio
+import hashlib
+import logging
 import os
 import os.path
 import re
+import time
+from functools import lru_cache
+
+logger = logging.getLogger("updates")
 
 re_1mb_image = re.compile(r'homething\.app[12]__(.*)\.ota')
 re_image = re.compile(r'homething__(.*)\.ota')
 
+# Directory mtimes may only have a resolution of a second or two, so a catalog built within this many seconds of the
+# directory changing might miss a change made in the same tick and is built again next time.
+MTIME_RESOLUTION = 2
+
+
+@lru_cache(maxsize=64)
+def get_flash_type(capabilities):
+    for entry in capabilities.split(','):
+        if entry.startswith('flash'):
+            return entry
+    return ''
+
+
+class FirmwareCatalog:
+    """Versions of the firmware images in a directory, newest first, for 1MB and larger flash."""
 
-class UpdateManager:
     def __init__(self, updates_dir):
+        images = []
+        with os.scandir(updates_dir) as entries:
+            for entry in entries:
+                images.append((entry.name, entry.stat().st_mtime))
+        images.sort(key=lambda x: x[1], reverse=True)
+        self.versions_1mb = self.get_versions(images, re_1mb_image)
+        self.versions = self.get_versions(images, re_image)
+        self.image_count = len(images)
+
+    @staticmethod
+    def get_versions(images, regex):
+        # There are two images for each version for 1MB flash, one for each app partition
+        versions = {}
+        for filename, _ in images:
+            m = regex.match(filename)
+            if m:
+                versions.setdefault(m.group(1), None)
+        return list(versions)
+
+    def get_versions_for_flash(self, flash_type):
+        if flash_type == 'flash1MB':
+            return self.versions_1mb
+        return self.versions
+
+
+class FirmwareImage:
+    """The content and checksums of a firmware image, read once and kept in memory while devices download it."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.data = f.read()
+        self.path = path
+        self.size = len(self.data)
+        self.version_key = (stat.st_size, stat.st_mtime_ns)
+        self.mtime = stat.st_mtime
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+
+class UpdateManager:
+    def __init__(self, updates_dir, firmware_url=None, max_image_cache_size=64 * 1024 * 1024):
         self.updates_dir = updates_dir
+        # URL devices download images from, when not set it is worked out from the request starting an update
+        self.firmware_url = firmware_url
+        self.catalog = None
+        self.catalog_mtime = None
+        self.catalog_builds = 0
+        self.max_image_cache_size = max_image_cache_size
+        self.images = {}
+        self.image_loads = {}
+        self.image_cache_size = 0
+
+    def get_catalog(self):
+        """Returns the catalog of images, which is only built again when the directory has changed."""
+        mtime = os.stat(self.updates_dir).st_mtime_ns
+        if self.catalog is None or mtime != self.catalog_mtime:
+            self.catalog = FirmwareCatalog(self.updates_dir)
+            self.catalog_builds += 1
+            if time.time() - mtime / 1e9 < MTIME_RESOLUTION:
+                self.catalog_mtime = None
+            else:
+                self.catalog_mtime = mtime
+        return self.catalog
 
     def get_versions(self, device):
-        flash_type = ''
-        for entry in device.info['capabilities'].split(','):
-            if entry.startswith('flash'):
-                flash_type = entry
-                break
+        return self.get_catalog().get_versions_for_flash(get_flash_type(device.info['capabilities']))
 
-        if flash_type == 'flash1MB':
-            regex = re_1mb_image
-        else:
-            regex = re_image
+    @staticmethod
+    def is_image(filename):
+        return re_image.fullmatch(filename) is not None or re_1mb_image.fullmatch(filename) is not None
 
-        versions = list()
-        for filename in os.listdir(self.updates_dir):
-            m = regex.match(filename)
-            if m:
-                mtime = os.path.getmtime(os.path.join(self.updates_dir, filename))
-                versions.append((m.group(1), mtime))
-        versions.sort(key=lambda x: x[1], reverse=True)
-        return [v for v, _ in versions]
+    async def get_image(self, path):
+        """Returns the FirmwareImage for path, reading it in a thread if it is not cached or has changed. Concurrent
+        requests for an image share one read. Returns None for images too large to cache."""
+        stat = os.stat(path)
+        if stat.st_size > self.max_image_cache_size:
+            logger.warning("Not serving %s, its size %d is over the image cache size", path, stat.st_size)
+            return None
+        image = self.images.pop(path, None)
+        if image is not None and image.version_key == (stat.st_size, stat.st_mtime_ns):
+            # Keep the most recently used images at the end
+            self.images[path] = image
+            return image
+        if image is not None:
+            self.image_cache_size -= image.size
+
+        load = self.image_loads.get(path)
+        if load is None:
+            load = asyncio.get_running_loop().run_in_executor(None, FirmwareImage, path)
+            self.image_loads[path] = load
+        try:
+            image = await asyncio.shield(load)
+        finally:
+            if self.image_loads.get(path) is load:
+                del self.image_loads[path]
+
+        cached = self.images.pop(path, None)
+        if cached is not None:
+            self.image_cache_size -= cached.size
+        self.images[path] = image
+        self.image_cache_size += image.size
+        while self.image_cache_size > self.max_image_cache_size and len(self.images) > 1:
+            evicted = self.images.pop(next(iter(self.images)))
+            self.image_cache_size -= evicted.size
+        return image
+
+    def stats(self):
+        return dict(catalog_builds=self.catalog_builds,
+                    images=self.catalog.image_count if self.catalog is not None else None,
+                    cached_images=len(self.images), image_cache_size=self.image_cache_size)
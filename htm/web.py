@@ -1,13 +1,19 @@
+import base64
 import os
+import struct
+import sys
 import datetime
-from tornado.web import Application, RequestHandler
+from array import array
+from tornado.ioloop import PeriodicCallback
+from tornado.web import Application, HTTPError, RequestHandler, StaticFileHandler
 from tornado.websocket import WebSocketHandler
 import humanize
-from parsimonious.exceptions import IncompleteParseError
-from cbor2 import dumps
+from cbor2 import dumps, CBOREncodeValueError
 from homething.parse import *
+from homething.validate import ProfileValidator
 from htm import notifications
 from htm import db
+from htm.rollout import RolloutManager
 from datatables import ColumnDT, DataTables
 import json
 import pytz
@@ -73,19 +79,56 @@ class DeviceProfilePageHandler(RequestHandler):
         source = ProfileSource()
         source.filename = ""
         source.text = self.get_argument("profile")
-        error_message = ''
-        try:
-            source.parse()
-            profile = source.process()
+        profile = source.compile()
+        if profile is not None:
             await device.set_profile(dumps(profile))
             self.redirect(f'/device/{device.uuid}/')
             return
-        except IncompleteParseError as e:
-            error_message = source.message_for_location(e.pos, 'error', 'Failed to parse')
+        await self.render("profile.html", device=device, profile=source.text, error=source.format_diagnostics())
+
+
+class DeviceProfileValidateHandler(RequestHandler):
+    """Validates the profile being edited, the request body is the profile text. Each device keeps a validator so only
+    the lines changed since the last request are validated again."""
+    MAX_VALIDATORS = 32
+    validators = {}
+
+    def initialize(self, devices):
+        self.devices = devices
+
+    def get_validator(self, device):
+        validator = self.validators.pop(device.uuid, None)
+        if validator is None:
+            validator = ProfileValidator()
+            if len(self.validators) >= self.MAX_VALIDATORS:
+                del self.validators[next(iter(self.validators))]
+        self.validators[device.uuid] = validator
+        return validator
+
+    def post(self, device_id):
+        device = self.devices.get_device(device_id)
+        if device is None:
+            self.send_error(404)
+            return
+
+        try:
+            text = self.request.body.decode()
+        except UnicodeDecodeError:
+            self.send_error(400)
+            return
+        validator = self.get_validator(device)
+        source, diagnostics = validator.validate(text)
+        results = []
+        for diagnostic in diagnostics:
+            line, column = source.line_and_column(diagnostic.location)
+            results.append(dict(location=diagnostic.location, line=line, column=column, type=diagnostic.type,
+                                message=diagnostic.message, text=source.message_for_location(*diagnostic)))
+        self.write(dict(diagnostics=results, processed_lines=validator.processed_lines))
 
-        except ProfileEntryError as e:
-            error_message = source.message_for_location(e.location, 'error', e.message)
-        await self.render("profile.html", device=device, profile=source.text, error=error_message)
+
+def get_firmware_url(updates, request):
+    """Returns the URL devices download firmware images from, served by FirmwareHandler."""
+    return updates.firmware_url or f"{request.protocol}://{request.host}/firmware/"
 
 
 class DeviceUpdateHandler(RequestHandler):
@@ -106,10 +149,118 @@ class DeviceUpdateHandler(RequestHandler):
         if device is None:
             self.send_error(404)
             return
-        await device.update(self.get_body_argument('version'))
+        await device.update(self.get_body_argument('version'), get_firmware_url(self.updates, self.request))
         self.redirect(f'/device/{device.uuid}/')
 
 
+class FirmwareHandler(StaticFileHandler):
+    """Serves the firmware images in updates_dir, with support for Range requests from StaticFileHandler.
+
+    Images are served from the copy kept by UpdateManager.get_image, so they are not read and hashed for each request.
+    The ETag is the SHA-256 of the image and the x-MD5 header is the MD5 checked by ESP8266 HTTP updates."""
+    def initialize(self, updates):
+        super().initialize(updates.updates_dir)
+        self.updates = updates
+        self.image = None
+
+    async def prepare(self):
+        if self.root is None:
+            # HTM was started without --updates_dir
+            raise HTTPError(404)
+        # Resolved as StaticFileHandler.get does, which validates the path again before serving it
+        self.path = self.parse_url_path(self.path_args[0])
+        if not self.updates.is_image(self.path):
+            # Only firmware images at the top of updates_dir are served
+            raise HTTPError(404)
+        absolute_path = self.validate_absolute_path(self.root, self.get_absolute_path(self.root, self.path))
+        if absolute_path is not None:
+            self.image = await self.updates.get_image(absolute_path)
+            if self.image is None:
+                raise HTTPError(404)
+
+    def compute_etag(self):
+        return f'"{self.image.sha256}"'
+
+    def set_extra_headers(self, path):
+        self.set_header("x-MD5", self.image.md5)
+        self.set_header("Digest", "sha-256=" + base64.b64encode(bytes.fromhex(self.image.sha256)).decode())
+
+    def get_content_size(self):
+        return self.image.size
+
+    def get_modified_time(self):
+        return datetime.datetime.fromtimestamp(int(self.image.mtime), datetime.timezone.utc)
+
+    def get_content(self, abspath, start=None, end=None):
+        # Unlike StaticFileHandler this is not a classmethod, the content comes from the image loaded by prepare().
+        # The image is written in one piece, which the IOStream sends from without copying it for each connection.
+        yield self.image.data[start:end]
+
+
+class RolloutsPageHandler(RequestHandler):
+    def initialize(self, rollouts, updates):
+        self.rollouts = rollouts
+        self.updates = updates
+
+    def render_page(self, error=None):
+        versions = []
+        if self.updates.updates_dir is not None:
+            catalog = self.updates.get_catalog()
+            versions = list(dict.fromkeys(catalog.versions + catalog.versions_1mb))
+        self.render("rollouts.html", rollouts=reversed(list(self.rollouts.get_rollouts())), versions=versions,
+                    error=error)
+
+    def get(self):
+        self.render_page()
+
+    def post(self):
+        try:
+            self.rollouts.start(self.get_body_argument('version'),
+                                firmware_url=get_firmware_url(self.updates, self.request),
+                                flash_type=self.get_body_argument('flash_type', None),
+                                from_version=self.get_body_argument('from_version', None),
+                                concurrency=int(self.get_body_argument('concurrency', 5)),
+                                wave_size=int(self.get_body_argument('wave_size', 20)),
+                                wave_interval=float(self.get_body_argument('wave_interval', 60)),
+                                timeout=float(self.get_body_argument('timeout', 300)),
+                                failure_threshold=float(self.get_body_argument('failure_threshold', 20)) / 100)
+        except ValueError as e:
+            self.set_status(400)
+            self.render_page(error=str(e))
+            return
+        self.redirect('/rollouts')
+
+
+class RolloutHandler(RequestHandler):
+    def initialize(self, rollouts):
+        self.rollouts = rollouts
+
+    def get(self, rollout_id):
+        rollout = self.rollouts.get_rollout(int(rollout_id))
+        if rollout is None:
+            self.send_error(404)
+            return
+        self.write(rollout._to_json())
+
+
+class RolloutActionHandler(RequestHandler):
+    def initialize(self, rollouts):
+        self.rollouts = rollouts
+
+    def post(self, rollout_id, action):
+        rollout = self.rollouts.get_rollout(int(rollout_id))
+        if rollout is None:
+            self.send_error(404)
+            return
+        if action == 'pause':
+            rollout.pause("Paused by user")
+        elif action == 'resume':
+            rollout.resume()
+        else:
+            rollout.cancel()
+        self.redirect('/rollouts')
+
+
 class DeviceRestartHandler(RequestHandler):
     def initialize(self, devices):
         self.devices = devices
@@ -127,13 +278,12 @@ class DeviceEventsDatatableHandler(RequestHandler):
     def initialize(self, devices) -> None:
         self.devices = devices
 
-    def get(self, device_id):
+    async def get(self, device_id):
         device = self.devices.get_device(device_id)
         if device is None:
             self.send_error(404)
             return
 
-        query = db.get_events_query(device_id)
         columns = [
             ColumnDT(db.Event.id, mData='id'),
             ColumnDT(db.Event.datetime, mData='datetime'),
@@ -141,9 +291,10 @@ class DeviceEventsDatatableHandler(RequestHandler):
             ColumnDT(db.Event.uptime, mData='uptime')
         ]
         args = {k: v[0].decode() for k, v in self.request.arguments.items()}
-        row_table = DataTables(args, query, columns)
+        result = await db.async_db.get_events_query(device_id,
+                                                    lambda query: DataTables(args, query, columns).output_result())
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(JSONEncoder().encode(row_table.output_result()))
+        self.write(JSONEncoder().encode(result))
         self.flush()
 
 
@@ -152,76 +303,429 @@ class DevicesJsonHandler(RequestHandler):
         self.devices = devices
 
     def get(self):
-        device_list = {"devices": [
-            {"id": device.uuid, "uptime": device.last_uptime, "version": device.info.get('version', ''),
-             "online": device.online, "description": device.info.get("description", "")}
-            for device in self.devices.get_devices()]}
+        since = self.get_argument("since", None)
+        if since is not None:
+            try:
+                changes = self.devices.get_changes(since)
+            except ValueError:
+                self.send_error(400)
+                return
+            self.write(changes)
+            self.flush()
+            return
 
-        self.write(device_list)
+        etag, snapshot = self.devices.get_snapshot()
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(snapshot)
         self.flush()
 
+    def compute_etag(self):
+        # The ETag is set from the devices version, avoid hashing the body.
+        return None
+
+
+def to_little_endian(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_memory_stats_columns(stats):
+    times = [stat.timestamp for stat in stats]
+    start = times[0] if times else 0
+    deltas = [timestamp - previous for timestamp, previous in zip(times, [start] + times)]
+    return (start, to_little_endian('i', deltas), to_little_endian('I', [stat.free for stat in stats]),
+            to_little_endian('I', [stat.min_free for stat in stats]))
+
+
+def parse_time(value):
+    try:
+        return datetime.datetime.fromtimestamp(float(value), pytz.utc)
+    except ValueError:
+        pass
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=pytz.utc)
+    return parsed.astimezone(pytz.utc)
+
 
 class DeviceMemoryStatsHandler(RequestHandler):
+    """Returns at most max_points memory stats between from and to, given as seconds since the epoch or ISO 8601 and
+    defaulting to the last 24 hours. Stats are returned as JSON by default. Compact columnar formats, where times are
+    seconds since the epoch delta encoded against the previous entry, are available as CBOR (format=cbor or Accept:
+    application/cbor) or as a little endian buffer laid out for direct use as typed arrays (format=binary or Accept:
+    application/octet-stream):
+    uint32 count, uint32 resolution, float64 start, int32 deltas[count], uint32 free[count], uint32 min_free[count]
+    """
+    FORMATS = {'application/cbor': 'cbor', 'application/octet-stream': 'binary'}
+
     def initialize(self, devices) -> None:
         self.devices = devices
 
-    def get(self, device_id):
+    def get_format(self):
+        response_format = self.get_argument("format", None)
+        if response_format is None:
+            accept = self.request.headers.get("Accept", "")
+            for content_type, content_format in self.FORMATS.items():
+                if content_type in accept:
+                    return content_format
+            return 'json'
+        return response_format
+
+    async def get(self, device_id):
         device = self.devices.get_device(device_id)
         if device is None:
             self.send_error(404)
             return
 
-        free = []
-        min_free = []
-        times = []
-        result = {"free": free, "times": times, "min_free": min_free}
-        to_time = datetime.datetime.now(pytz.utc)
-        from_time = to_time - datetime.timedelta(days=1)
-        for log in db.get_memory_logs(device_id, from_time, to_time):
-            times.append(log.datetime)
-            min_free.append(log.min_free)
-            free.append(log.free)
+        response_format = self.get_format()
+        if response_format not in ('json', 'cbor', 'binary'):
+            self.send_error(400)
+            return
+        try:
+            to_time = self.get_argument("to", None)
+            to_time = datetime.datetime.now(pytz.utc) if to_time is None else parse_time(to_time)
+            from_time = self.get_argument("from", None)
+            if from_time is None:
+                from_time = to_time - datetime.timedelta(hours=float(self.get_argument("hours", "24")))
+            else:
+                from_time = parse_time(from_time)
+            max_points = int(self.get_argument("max_points", "500"))
+        except (ValueError, OverflowError, OSError):
+            self.send_error(400)
+            return
+        if from_time >= to_time or max_points < 1:
+            self.send_error(400)
+            return
+        resolution, stats = await db.async_db.get_memory_stats(device_id, from_time, to_time, max_points)
+
+        if response_format == 'json':
+            result = {"times": [datetime.datetime.fromtimestamp(stat.timestamp, pytz.utc).replace(tzinfo=None)
+                                for stat in stats],
+                      "free": [stat.free for stat in stats],
+                      "free_min": [stat.free_min for stat in stats],
+                      "free_max": [stat.free_max for stat in stats],
+                      "min_free": [stat.min_free for stat in stats],
+                      "resolution": resolution}
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write(JSONEncoder().encode(result))
+
+        else:
+            start, deltas, free, min_free = encode_memory_stats_columns(stats)
+            if response_format == 'cbor':
+                self.set_header("Content-Type", "application/cbor")
+                self.write(dumps({"resolution": resolution, "start": start, "deltas": deltas, "free": free,
+                                  "free_min": to_little_endian('I', [stat.free_min for stat in stats]),
+                                  "free_max": to_little_endian('I', [stat.free_max for stat in stats]),
+                                  "min_free": min_free}))
+            else:
+                self.set_header("Content-Type", "application/octet-stream")
+                self.write(struct.pack('<IId', len(stats), resolution, start) + deltas + free + min_free)
+        self.flush()
+
+
+class FleetMemoryStatsHandler(RequestHandler):
+    MAX_LIMIT = 500
+
+    def initialize(self, devices) -> None:
+        self.devices = devices
+
+    async def get(self):
+        sort = self.get_argument("sort", "lowest_min_free")
+        order = self.get_argument("order", "asc")
+        try:
+            to_time = datetime.datetime.now(pytz.utc)
+            from_time = to_time - datetime.timedelta(hours=float(self.get_argument("hours", "24")))
+            offset = int(self.get_argument("offset", "0"))
+            limit = int(self.get_argument("limit", "50"))
+        except (ValueError, OverflowError):
+            self.send_error(400)
+            return
+        if sort not in db.FLEET_MEMORY_SORT_COLUMNS or order not in ('asc', 'desc') or offset < 0 or \
+                not 0 < limit <= self.MAX_LIMIT:
+            self.send_error(400)
+            return
+
+        total, stats = await db.async_db.get_fleet_memory_stats(from_time, to_time, sort, order == 'desc', offset,
+                                                                 limit)
+        for entry in stats:
+            device = self.devices.get_device(entry['device'])
+            entry['description'] = '' if device is None else device.info.get('description', '')
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(JSONEncoder().encode(result))
+        self.write(JSONEncoder().encode({"total": total, "offset": offset, "devices": stats}))
         self.flush()
 
 
+class StatsHandler(RequestHandler):
+    def initialize(self, devices, retention, updates, rollouts) -> None:
+        self.devices = devices
+        self.retention = retention
+        self.updates = updates
+        self.rollouts = rollouts
+
+    def get(self):
+        self.write({"db": dict(write_buffer=db.write_buffer.stats(), executor=db.async_db.stats(),
+                               retention=self.retention.stats()),
+                    "notifications": notifications.manager.stats(),
+                    "devices": dict(count=len(self.devices.devices), routes=len(self.devices.routes),
+                                    skipped_messages=self.devices.skipped_messages),
+                    "updates": self.updates.stats(),
+                    "rollouts": self.rollouts.stats()})
+        self.flush()
+
+
+def encode_json_message(event, data):
+    return JSONEncoder().encode({"event": event, "data": data}).encode()
+
+
+def cbor_default(encoder, value):
+    if not hasattr(value, '_to_json'):
+        raise CBOREncodeValueError(f"Unable to encode {type(value).__name__}")
+    encoder.encode(value._to_json())
+
+
+def encode_cbor_message(event, data):
+    return dumps({"event": event, "data": data}, default=cbor_default, datetime_as_timestamp=True, timezone=pytz.utc)
+
+
+MESSAGE_ENCODERS = {'json': encode_json_message, 'cbor': encode_cbor_message}
+
+# Shared by all update WebSockets, note that each connection still has its own compressor.
+websocket_compression_options = dict(compression_level=6, mem_level=8)
+
+
+class Broadcaster:
+    """Encodes each notification once per format and shares the encoded message with every subscribed WebSocket,
+    each WebSocket has its own queue so a slow client does not hold up the others. When lossless is set a WebSocket
+    whose queue fills up is closed with code 1013 rather than losing messages, so the client can start again from the
+    current state."""
+    lossless = False
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def start(self):
+        raise NotImplementedError('start needs to be implemented by subclass')
+
+    def stop(self):
+        raise NotImplementedError('stop needs to be implemented by subclass')
+
+    def subscribe(self, handler):
+        if not self.subscribers:
+            self.start()
+        on_overflow = handler.close_overflowed if self.lossless else None
+        self.subscribers[handler] = notifications.manager.create_queue(handler.send_encoded_message,
+                                                                       on_overflow=on_overflow)
+
+    def unsubscribe(self, handler):
+        notifications.manager.release_queue(self.subscribers.pop(handler))
+        if not self.subscribers:
+            self.stop()
+
+    def __call__(self, device, event, data):
+        messages = {}
+        for handler, listener in self.subscribers.items():
+            message = messages.get(handler.message_format)
+            if message is None:
+                message = MESSAGE_ENCODERS[handler.message_format](event, data)
+                messages[handler.message_format] = message
+            listener(device, event, message)
+
+
+class DeviceBroadcaster(Broadcaster):
+    # Messages update the device page in place, after one is lost the page shows stale values
+    lossless = True
+    broadcasters = {}
+
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+
+    @classmethod
+    def get(cls, device):
+        broadcaster = cls.broadcasters.get(device)
+        if broadcaster is None:
+            broadcaster = cls.broadcasters[device] = cls(device)
+        return broadcaster
+
+    def start(self):
+        notifications.manager.add_device_listener(self.device, self)
+
+    def stop(self):
+        notifications.manager.remove_device_listener(self.device, self)
+        del self.broadcasters[self.device]
+
+
+class FleetBroadcaster(Broadcaster):
+    """Collects changes to the fields shown in the devices table from all devices and broadcasts them as a single
+    devices message every interval seconds. Each entry maps a device id to its changed fields, a device that has not
+    been sent before gets all fields and a removed device maps to None. Messages are changes to the previous ones so
+    none may be dropped."""
+    lossless = True
+
+    def __init__(self, devices, interval):
+        super().__init__()
+        self.devices = devices
+        self.interval = interval
+        self.changes = {}
+        self.known = set()
+        self.flush_callback = None
+
+    def snapshot(self):
+        summaries = {device.uuid: device.summary() for device in self.devices.get_devices()}
+        for uuid, summary in summaries.items():
+            if uuid not in self.known and self.changes.get(uuid) is not None:
+                # Earlier subscribers have not been sent this device yet, the pending changes must hold all fields
+                self.changes[uuid] = dict(summary)
+        self.known.update(summaries)
+        return summaries
+
+    def start(self):
+        self.snapshot()
+        notifications.manager.add_listener(self.device_listener)
+        self.flush_callback = PeriodicCallback(self.flush, self.interval * 1000)
+        self.flush_callback.start()
+
+    def stop(self):
+        notifications.manager.remove_listener(self.device_listener)
+        self.flush_callback.stop()
+        self.flush_callback = None
+        self.changes.clear()
+        self.known.clear()
+
+    def device_listener(self, device, event, data):
+        if event == 'online':
+            changes = dict(online=data)
+        elif event == 'uptime':
+            changes = dict(uptime=data['uptime'])
+        elif event == 'info':
+            changes = dict(version=data.get('version', ''), description=data.get('description', ''))
+        elif event == 'deleted':
+            self.changes[device.uuid] = None
+            return
+        else:
+            return
+
+        device_changes = self.changes.get(device.uuid)
+        if device_changes is None:
+            self.changes[device.uuid] = changes
+        else:
+            device_changes.update(changes)
+
+    def flush(self):
+        if not self.changes:
+            return
+        changes, self.changes = self.changes, {}
+        for uuid, device_changes in changes.items():
+            if device_changes is None:
+                self.known.discard(uuid)
+            elif uuid not in self.known:
+                device = self.devices.get_device(uuid)
+                if device is None:
+                    changes[uuid] = None
+                else:
+                    changes[uuid] = device.summary()
+                    self.known.add(uuid)
+        self(None, 'devices', changes)
+
+
+class FleetUpdatesWebSocketHandler(WebSocketHandler):
+    def initialize(self, broadcaster) -> None:
+        self.broadcaster = broadcaster
+        self.message_format = 'json'
+
+    def get_compression_options(self):
+        return websocket_compression_options
+
+    def open(self):
+        self.message_format = self.get_argument("format", "json")
+        if self.message_format not in MESSAGE_ENCODERS:
+            self.close(reason="Unknown format")
+            return
+
+        self.broadcaster.subscribe(self)
+        self.write_message(MESSAGE_ENCODERS[self.message_format]('snapshot', self.broadcaster.snapshot()),
+                           binary=self.message_format != 'json')
+
+    def send_encoded_message(self, device, event, message):
+        return self.write_message(message, binary=self.message_format != 'json')
+
+    def close_overflowed(self):
+        # Called while the broadcaster is iterating its subscribers, on_close unsubscribes later
+        self.close(code=1013, reason="Too far behind")
+
+    def on_close(self):
+        if self in self.broadcaster.subscribers:
+            self.broadcaster.unsubscribe(self)
+
+
 class DeviceUpdatesWebSocketHandler(WebSocketHandler):
     def initialize(self, devices) -> None:
         self.devices = devices
         self.device = None
+        self.message_format = 'json'
+
+    def get_compression_options(self):
+        return websocket_compression_options
 
     def open(self, device_id):
         self.device = self.devices.get_device(device_id)
         if self.device is None:
-            self.send_error(404)
+            self.close(reason="Unknown device")
+            return
+
+        self.message_format = self.get_argument("format", "json")
+        if self.message_format not in MESSAGE_ENCODERS:
+            self.close(reason="Unknown format")
             return
 
         # Register for notifications
-        notifications.manager.add_device_listener(self.device, self.device_listener)
+        DeviceBroadcaster.get(self.device).subscribe(self)
 
-    def device_listener(self, device, event, data):
-        self.write_message(JSONEncoder().encode({"event": event, "data": data}))
+    def send_encoded_message(self, device, event, message):
+        return self.write_message(message, binary=self.message_format != 'json')
+
+    def close_overflowed(self):
+        # Called while the broadcaster is iterating its subscribers, on_close unsubscribes later
+        self.close(code=1013, reason="Too far behind")
 
     def on_message(self, message):
         print(f"Message received: {message}")
 
     def on_close(self):
         # Cancel notifications
-        notifications.manager.remove_device_listener(self.device, self.device_listener)
+        broadcaster = DeviceBroadcaster.broadcasters.get(self.device)
+        if broadcaster is not None and self in broadcaster.subscribers:
+            broadcaster.unsubscribe(self)
 
 
-def get_server(devices, updates):
+def get_server(devices, updates, retention, fleet_update_interval=1.0):
+    fleet_broadcaster = FleetBroadcaster(devices, fleet_update_interval)
+    rollouts = RolloutManager(devices, updates)
 
     return Application([(r'/', MainPageHandler, dict(devices=devices)),
                         (r'/devices', DevicesJsonHandler, dict(devices=devices)),
+                        (r'/devices/ws', FleetUpdatesWebSocketHandler, dict(broadcaster=fleet_broadcaster)),
+                        (r'/devices/memorystats', FleetMemoryStatsHandler, dict(devices=devices)),
+                        (r'/stats', StatsHandler,
+                         dict(devices=devices, retention=retention, updates=updates, rollouts=rollouts)),
                         (r'/device/([^/]+)/', DevicePageHandler, dict(devices=devices)),
                         (r'/device/([^/]+)/profile', DeviceProfilePageHandler, dict(devices=devices)),
+                        (r'/device/([^/]+)/profile/validate', DeviceProfileValidateHandler, dict(devices=devices)),
                         (r'/device/([^/]+)/update', DeviceUpdateHandler, dict(devices=devices, updates=updates)),
                         (r'/device/([^/]+)/restart', DeviceRestartHandler, dict(devices=devices)),
                         (r'/device/([^/]+)/events', DeviceEventsDatatableHandler, dict(devices=devices)),
                         (r'/device/([^/]+)/memorystats', DeviceMemoryStatsHandler, dict(devices=devices)),
-                        (r'/device/([^/]+)/ws', DeviceUpdatesWebSocketHandler, dict(devices=devices))
+                        (r'/device/([^/]+)/ws', DeviceUpdatesWebSocketHandler, dict(devices=devices)),
+                        (r'/firmware/(.*)', FirmwareHandler, dict(updates=updates)),
+                        (r'/rollouts', RolloutsPageHandler, dict(rollouts=rollouts, updates=updates)),
+                        (r'/rollout/([0-9]+)', RolloutHandler, dict(rollouts=rollouts)),
+                        (r'/rollout/([0-9]+)/(pause|resume|cancel)', RolloutActionHandler, dict(rollouts=rollouts))
                         ],
                        template_path=os.path.join(os.path.dirname(__file__), 'templates'),
                        static_path=os.path.join(os.path.dirname(__file__), 'static'),
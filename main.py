@@ -1,31 +1,68 @@
 import htm.logging
 import tornado.ioloop
 import argparse
+import datetime
+import signal
 from htm.devices import Devices
+from htm.db import async_db, backfill_memory_rollups
 from htm import mqtt
 from htm import web
 from htm.updates import UpdateManager
+from htm.retention import RetentionManager, ROLLUP_RETENTION_DAYS, get_policies, rollup_policy_name
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Web based HomeThing Manager")
     parser.add_argument("--updates_dir", type=str, help="Location of firmware update files.")
+    parser.add_argument("--firmware_url", type=str,
+                        help="URL devices download the firmware update files served by HTM from, by default "
+                             "http://<host used to start the update>/firmware/.")
     parser.add_argument("--ip", type=str, help="IP address to bind to, by default this is all IPs", default="0.0.0.0")
     parser.add_argument("--port", type=int, help="Port to make the web server available on.", default=8888)
     parser.add_argument("--mqtt", type=str, help="URL for the MQTT server to connect to.", default="mqtt://localhost")
+    parser.add_argument("--memory_log_retention", type=float, default=48,
+                        help="Number of hours to keep raw memory logs for.")
+    parser.add_argument("--event_retention", type=float, default=90, help="Number of days to keep events for.")
+    for resolution, days in ROLLUP_RETENTION_DAYS.items():
+        name = rollup_policy_name(resolution)
+        parser.add_argument(f"--{name}_retention", type=float, default=days,
+                            help=f"Number of days to keep {name.split('_')[1]} memory rollups for.")
+    parser.add_argument("--enable_incremental_vacuum", action="store_true",
+                        help="Switch the database to incremental vacuum so free pages are reclaimed, this runs a full "
+                             "VACUUM once which blocks writes until it completes.")
+    parser.add_argument("--fleet_update_interval", type=float, default=1.0,
+                        help="Number of seconds to batch device list changes for before sending them to browsers.")
     args = parser.parse_args()
 
     db = Devices()
 
-    # Check that devices are still online and if not update the event log
-    online_check = tornado.ioloop.PeriodicCallback(db.check_devices_online, 1000)
-    online_check.start()
+    # Write out buffered events and memory logs that have been waiting too long
+    write_buffer_flush = tornado.ioloop.PeriodicCallback(async_db.flush_if_due, 1000)
+    write_buffer_flush.start()
+    tornado.ioloop.IOLoop.current().spawn_callback(async_db.run, backfill_memory_rollups)
+
+    # Remove expired events and memory logs
+    rollup_max_ages = {resolution: datetime.timedelta(days=getattr(args, f"{rollup_policy_name(resolution)}_retention"))
+                       for resolution in ROLLUP_RETENTION_DAYS}
+    retention = RetentionManager(get_policies(datetime.timedelta(hours=args.memory_log_retention),
+                                              datetime.timedelta(days=args.event_retention), rollup_max_ages),
+                                 enable_incremental_vacuum=args.enable_incremental_vacuum)
+    retention_check = tornado.ioloop.PeriodicCallback(retention.run, 60 * 60 * 1000)
+    retention_check.start()
+    tornado.ioloop.IOLoop.current().spawn_callback(retention.run)
 
     mqtt_handler = mqtt.get_handler(args.mqtt, db)
     mqtt_handler.connect()
 
-    updates = UpdateManager(args.updates_dir)
+    updates = UpdateManager(args.updates_dir, args.firmware_url)
 
-    web_server = web.get_server(db, updates)
+    web_server = web.get_server(db, updates, retention, args.fleet_update_interval)
     web_server.listen(args.port, args.ip)
 
-    tornado.ioloop.IOLoop.current().start()
+    io_loop = tornado.ioloop.IOLoop.current()
+    # Stop the loop on SIGTERM from service managers as well as on Ctrl-C so buffered writes are flushed
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        io_loop.asyncio_loop.add_signal_handler(signum, io_loop.stop)
+    try:
+        io_loop.start()
+    finally:
+        async_db.close()